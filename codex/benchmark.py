@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Benchmarks of the crawl and export path on a fixed corpus.
+
+Pages and orna.guide tiers come from a recorded archive (see `main.py
+--record`), by default the fixture corpus in fixtures/ with its index, or
+from the HTTP cache and index of main.py with --cache. Each measurement
+reports best and mean time of --repeat runs or more, repeating short runs
+for MIN_SECONDS, and peak memory traced by tracemalloc in one more run.
+Results can be saved with --save and compared with a saved baseline with
+--compare, which compares mean time and peak memory, and exits with status
+1 on regression beyond --tolerance. Post-passes and serialization run on
+codex records, as export does.
+
+The fixture is a small synthetic site of codex pages in en and zh-hans,
+listing pages and orna.guide tiers, recorded by `main.py --index` and
+`--export`. fixtures/baseline.json is the median of runs on the fixture
+with default options, and is to be saved again on another machine:
+
+    python codex/benchmark.py all --compare codex/fixtures/baseline.json
+'''
+
+import argparse
+import copy
+import gc
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+from codex_parser import BACKENDS, id_from_url
+from exporter import Exporter
+from indexer import Indexer
+from main import CATEGORIES, INDEX_FILE
+from record import CodexRecord
+from utils import TEXTS, HttpSession, ResponseArchive, write_json
+
+logging.basicConfig(
+    format="[%(asctime)s] %(levelname)s %(funcName)s:%(lineno)d %(message)s",
+    stream=sys.stdout,
+)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+FIXTURE_ARCHIVE = os.path.join(FIXTURES, "corpus.zip")
+FIXTURE_INDEX = os.path.join(FIXTURES, "index.txt")
+# short runs are repeated for this long at least, so their mean is stable,
+# unless the measurement with setups of runs takes MAX_SECONDS
+MIN_SECONDS = 1.0
+MAX_SECONDS = 10.0
+
+
+def measure(run, repeat, setup=None):
+    ''' Best and mean time of `run(setup())` in `repeat` runs or more, and
+    its peak memory. Runs are repeated until they take MIN_SECONDS in total,
+    or MAX_SECONDS with their setups. '''
+    started = time.perf_counter()
+    best = None
+    runs = 0
+    total = 0
+    while runs < repeat or (total < MIN_SECONDS and
+                            time.perf_counter() - started < MAX_SECONDS):
+        arg = setup() if setup is not None else None
+        # as timeit, keep collections of garbage out of timing
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            run(arg)
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+        runs += 1
+        total += elapsed
+    arg = setup() if setup is not None else None
+    tracemalloc.start()
+    try:
+        run(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": best, "mean_seconds": total / runs,
+            "peak_bytes": peak}
+
+
+class Corpus:
+    ''' Pages of codexes in index, orna.guide, and the session serving them '''
+
+    def __init__(self, langs, limit, replay=None, index=INDEX_FILE):
+        self.langs = langs
+        self.index = index
+        self.http_options = {"rate_limit": 0}
+        if replay is not None:
+            self.http_options.update(
+                archive=ResponseArchive.load(replay), replay=True)
+        self.http = HttpSession(**self.http_options)
+        with open(index, 'r', encoding='utf-8') as file:
+            paths = [path.strip() for path in file.readlines()]
+        self.paths = paths[:limit] if limit else paths
+        self.pages = []
+        for lang in langs:
+            for path in self.paths:
+                resp = self.http.get_playorna_com(path, lang)
+                if resp.status_code == 200:
+                    self.pages.append((path, lang, resp.text))
+        logger.info("Loaded pages=%d", len(self.pages))
+        exporter = self.exporter()
+        exporter.prepare()
+        exporter.wait_guide()
+        self.guide = exporter.guide
+        self.codexes = None
+
+    def records(self):
+        ''' Parsed codexes as records, which post-passes run on in export '''
+        return {
+            lang: {id_: CodexRecord(codex) for id_, codex in codexes.items()}
+            for lang, codexes in copy.deepcopy(self.parse_all()).items()
+        }
+
+    def exporter(self):
+        return Exporter(self.index, self.langs, parse_cache=False,
+                        http_options=self.http_options)
+
+    def parse_all(self):
+        ''' Codexes parsed from pages, {lang: {id: codex}} '''
+        if self.codexes is None:
+            parsers = {lang: BACKENDS["lxml"](lang) for lang in self.langs}
+            self.codexes = {lang: {} for lang in self.langs}
+            for path, lang, html in self.pages:
+                self.codexes[lang][id_from_url(path)] = \
+                    parsers[lang].parse_item(path, html)
+        return self.codexes
+
+
+def bench_parser(corpus, repeat):
+    ''' Compare parse time of backends, and check their output is same '''
+    results = {}
+    outputs = {}
+    for name, backend in BACKENDS.items():
+        parsers = {lang: backend(lang) for lang in corpus.langs}
+
+        def run(_, parsers=parsers, name=name):
+            outputs[name] = [
+                parsers[lang].parse_item(path, html)
+                for path, lang, html in corpus.pages
+            ]
+        results[f"parser.{name}"] = {
+            **measure(run, repeat), "count": len(corpus.pages)}
+
+    for name in BACKENDS:
+        mismatched = sum(
+            1 for output, other in zip(outputs[name], outputs["soup"])
+            if output != other)
+        results[f"parser.{name}"]["mismatched"] = mismatched
+    return results
+
+
+def bench_crawl(corpus, repeat):
+    ''' Throughput of `Indexer.consume_queue` after bootstrap '''
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "index.txt")
+        indexers = []
+
+        def setup():
+            indexer = Indexer(path, CATEGORIES,
+                              http_options=corpus.http_options)
+            indexer.bootstrap()
+            indexers.append(indexer)
+            return indexer
+
+        result = measure(lambda indexer: indexer.consume_queue(),
+                         repeat, setup)
+    return {"crawl.consume_queue": {
+        **result, "count": len(indexers[-1].known)}}
+
+
+def timed(totals, name, func):
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            key = name if name != "extract_list" else f"{name}.{args[1]}"
+            totals[key] += time.perf_counter() - start
+    return wrapper
+
+
+def bench_extractors(corpus, repeat):
+    ''' Latency of `parse_item` per page, broken down by extractor '''
+    results = {}
+    for name, backend in BACKENDS.items():
+        parsers = {lang: backend(lang) for lang in corpus.langs}
+        totals = defaultdict(float)
+        for parser in parsers.values():
+            for method in ("load", "page_nodes", "extract_name",
+                           "extract_info", "extract_list"):
+                setattr(parser, method,
+                        timed(totals, method, getattr(parser, method)))
+        runs = []
+
+        def run(_, parsers=parsers, totals=totals, runs=runs):
+            totals.clear()
+            for path, lang, html in corpus.pages:
+                parsers[lang].parse_item(path, html)
+            runs.append(dict(totals))
+        results[f"extractors.{name}.parse_item"] = {
+            **measure(run, repeat), "count": len(corpus.pages)}
+        # breakdown of the fastest run and mean of runs, the last is traced
+        timed_runs = runs[:-1]
+        best = min(timed_runs, key=lambda totals: sum(totals.values()))
+        for key, seconds in sorted(best.items()):
+            results[f"extractors.{name}.{key}"] = {
+                "seconds": seconds,
+                "mean_seconds": sum(totals.get(key, 0) for totals in timed_runs)
+                / len(timed_runs),
+                "count": len(corpus.pages)}
+    return results
+
+
+def bench_postpass(corpus, repeat):
+    ''' Post passes on parsed codexes of all languages '''
+    exporter = corpus.exporter()
+    exporter.guide = corpus.guide
+    count = sum(len(lang_codexes)
+                for lang_codexes in corpus.parse_all().values())
+    results = {}
+    for name in ("add_guide", "export_relations", "export_options",
+                 "export_facets"):
+        func = getattr(exporter, name)
+
+        def run(copied, func=func, name=name):
+            for lang_codexes in copied.values():
+                if name == "add_guide":
+                    for codex in lang_codexes.values():
+                        func(codex['path'], codex)
+                elif name == "export_facets":
+                    func(lang_codexes, exporter.export_options(lang_codexes))
+                else:
+                    func(lang_codexes)
+        results[f"postpass.{name}"] = {
+            **measure(run, repeat, corpus.records),
+            "count": count}
+    return results
+
+
+def bench_serialize(corpus, repeat):
+    ''' Writing exported data of all languages as JSON, as export does '''
+    exporter = corpus.exporter()
+    datas = {}
+    for lang, lang_codexes in corpus.records().items():
+        exporter.export_relations(lang_codexes)
+        datas[lang] = {
+            "text": TEXTS[lang],
+            "category": exporter.export_category(lang),
+            "codex": lang_codexes,
+            "options": exporter.export_options(lang_codexes),
+        }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, compact in (("indented", False), ("compact", True)):
+            sizes = {}
+
+            def run(_, compact=compact, sizes=sizes):
+                for lang, data in datas.items():
+                    sizes[lang] = write_json(
+                        os.path.join(directory, f"{lang}.json"), data,
+                        compact=compact)
+            results[f"serialize.{name}"] = {
+                **measure(run, repeat), "count": len(datas),
+                "bytes": sum(sizes.values())}
+    return results
+
+
+def report(results, baseline=None, tolerance=0.2):
+    ''' Print results, return names regressed from baseline '''
+    regressed = []
+    for name, result in results.items():
+        line = (f"{name:<42} {result['seconds'] * 1000:10.3f} ms "
+                f"{result['seconds'] / max(result['count'], 1) * 1000:8.3f} "
+                f"ms/item")
+        if 'peak_bytes' in result:
+            line += f" {result['peak_bytes'] / 1024:10.0f} KiB"
+        if 'mismatched' in result:
+            line += f" mismatched={result['mismatched']}"
+        if baseline is not None and name in baseline:
+            for metric in ('mean_seconds', 'peak_bytes'):
+                if metric not in result or not baseline[name].get(metric):
+                    continue
+                ratio = result[metric] / baseline[name][metric]
+                line += f" {metric}{ratio - 1:+.1%}"
+                if ratio > 1 + tolerance:
+                    regressed.append(f"{name}.{metric}")
+        print(line)
+    return regressed
+
+
+SUITES = {
+    "parser": bench_parser,
+    "crawl": bench_crawl,
+    "extractors": bench_extractors,
+    "postpass": bench_postpass,
+    "serialize": bench_serialize,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('suites', metavar='SUITE', nargs='+',
+                        choices=tuple(SUITES) + ('all',))
+    parser.add_argument('--langs', metavar='LANG[,LANG,...]', default='en')
+    parser.add_argument('--limit', metavar='N', type=int, default=0,
+                        help="number of codex paths from index, 0 for all")
+    parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                        help="runs of each measurement at least")
+    parser.add_argument('--replay', metavar='ARCHIVE', default=FIXTURE_ARCHIVE,
+                        help="load pages from a recorded archive, default to the fixture")
+    parser.add_argument('--index', metavar='FILE', default=FIXTURE_INDEX,
+                        help="codex paths of the corpus, default to index of the fixture")
+    parser.add_argument('--cache', action='store_true',
+                        help="load pages from the HTTP cache with index of main.py instead")
+    parser.add_argument('--save', metavar='FILE',
+                        help="save results as baseline")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare results with a saved baseline")
+    parser.add_argument('--tolerance', metavar='RATIO', type=float,
+                        default=0.2, help="allowed slowdown in --compare")
+    args = parser.parse_args()
+
+    suites = tuple(SUITES) if 'all' in args.suites else args.suites
+    if args.cache:
+        corpus = Corpus(args.langs.split(','), args.limit)
+    else:
+        corpus = Corpus(args.langs.split(','), args.limit, args.replay,
+                        args.index)
+    # keep progress logs of the measured code out of the report
+    for name in ("indexer", "exporter", "relations", "search", "utils"):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+    results = {}
+    for suite in suites:
+        results.update(SUITES[suite](corpus, args.repeat))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)["results"]
+    regressed = report(results, baseline, args.tolerance)
+    if args.save:
+        write_json(args.save, {"repeat": args.repeat, "results": results})
+    if regressed:
+        print(f"Regressed: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
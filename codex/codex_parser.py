@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import logging
+import re
+
+import lxml.html
+from bs4 import BeautifulSoup, Tag
+from lxml import etree
+from utils import TEXTS
+
+
+def normalize(string: str):
+    string = string \
+        .replace('✓', '') \
+        .replace('★', '') \
+        .strip()
+    try:
+        return int(string)
+    except ValueError:
+        return string
+
+
+ID_PATTERN = re.compile(r"/codex/(\w+?/[\w-]+?)/")
+CATEGORY_PATTERN = re.compile(r"/codex/(\w+?)/[\w-]+?/")
+STATUS_PATTERN = re.compile(r'^(.+) \((\d+)%\)$')
+ANY_PATTERN = re.compile(r'^(.+)$')
+
+
+def id_from_url(path: str):
+    return ID_PATTERN.match(path).group(1)
+
+
+def category_from_url(path: str):
+    return CATEGORY_PATTERN.match(path).group(1)
+
+
+class CodexParser:
+    ''' Parse codex pages of playorna.com in one language '''
+
+    # Bump when output changes, to invalidate cached results
+    VERSION = 1
+
+    def __init__(self, lang):
+        self.lang = lang
+        self.texts = TEXTS[lang]
+        self.meta_rules = None
+
+    def parse_item(self, path: str, html: str):
+        root = self.load(html)
+        try:
+            return self.parse_tree(path, root)
+        finally:
+            self.release(root)
+
+    def parse_tree(self, path: str, root):
+        codex = {
+            "name": self.extract_name(root),
+            "path": path,
+            "category": category_from_url(path),
+        }
+
+        # codex page
+        extractors = iter([
+            (self.extract_info,),
+            (self.extract_list,
+             "causes", self.texts["causes"], self.parse_status),
+            (self.extract_list,
+             "cures", self.texts["cures"], self.parse_status),
+            (self.extract_list,
+             "gives", self.texts["gives"], self.parse_status),
+            (self.extract_list,
+             "immunities", self.texts["immunities"], self.parse_status),
+            (self.extract_list,
+             "dropped_by", self.texts["droppedBy"], self.parse_href),
+            (self.extract_list,
+             "materials", self.texts["materials"], self.parse_href),
+            (self.extract_list,
+             "spells", self.texts["skills"], self.parse_href),
+            (self.extract_list,
+             "drops", self.texts["drops"], self.parse_href),
+        ])
+        nodes = self.page_nodes(root)
+
+        try:
+            extract, *extract_args = next(extractors)
+            while len(nodes) >= 1:
+                ret = extract(nodes, *extract_args)
+                if ret is not None:
+                    codex.update(ret)
+                else:
+                    extract, *extract_args = next(extractors)
+        except StopIteration:
+            pass
+
+        # cleanup
+        for key, value in tuple(codex.items()):
+            if value is None:
+                del codex[key]
+            if isinstance(value, (str, list, tuple)) and len(value) == 0:
+                del codex[key]
+
+        return codex
+
+    # Document access, overridden by other backends
+
+    def load(self, html: str):
+        return BeautifulSoup(html, "lxml")
+
+    def release(self, root) -> None:
+        ''' Free the tree now, soup trees have reference cycles '''
+        root.decompose()
+
+    def page_nodes(self, root) -> list:
+        return list(filter(
+            lambda node: isinstance(node, Tag) and node.name != 'hr',
+            root.select_one(".codex-page").children))
+
+    def select(self, node, selector: str) -> list:
+        return node.select(selector)
+
+    def select_one(self, node, selector: str):
+        return node.select_one(selector)
+
+    def name_of(self, node) -> str:
+        return node.name
+
+    def classes_of(self, node):
+        return node.get('class', tuple())
+
+    def attr_of(self, node, name: str) -> str:
+        return node[name]
+
+    def string_of(self, node):
+        return node.string
+
+    def stripped_text_of(self, node) -> str:
+        return ''.join(node.stripped_strings)
+
+    # Extractors
+
+    def extract_name(self, root):
+        return str(self.string_of(self.select_one(root, ".herotext")))
+
+    def extract_info(self, nodes: list):
+        node = nodes.pop(0)
+        classes = self.classes_of(node)
+        # image
+        sub = self.select_one(node, '.codex-page-icon img')
+        if sub is not None:
+            return {'image_url': self.attr_of(sub, 'src')}
+        # tags
+        subs = self.select(node, '.codex-page-tag')
+        if len(subs) >= 1:
+            return {'tags': [normalize(self.string_of(e)) for e in subs]}
+        # stats
+        subs = self.select(node, '.codex-stat')
+        if len(subs) >= 1:
+            return {'stats': [normalize(self.string_of(e)) for e in subs]}
+        # meta
+        if self.meta_rules is None:
+            self.meta_rules = [
+                (key, re.compile(f"^({self.texts[key]})$"), lambda s: True)
+                for key in ['exotic']
+            ] + [
+                (key, re.compile(f"^{self.texts[key]}: *(.+)$"), None)
+                for key in ["family", "place", "rarity", "tier", "useableBy"]
+            ] + [
+                ('events', re.compile(f"^{self.texts['event']}: *(.+)$"),
+                 lambda string: sorted([normalize(s) for s in string.split('/')])),
+            ]
+        if 'codex-page-description' in classes or 'codex-page-meta' in classes:
+            string = self.stripped_text_of(node)
+            # meta
+            for key, pattern, parse in self.meta_rules:
+                matched = pattern.match(string)
+                if matched is None:
+                    continue
+                if parse is None:
+                    parse = normalize
+                return {key: parse(matched.group(1))}
+            # description
+            if 'codex-page-description' in classes:
+                return {'description': string}
+            logging.warning("Unknown meta node: %s", node)
+        # bypass until h4
+        if self.name_of(node) != 'h4':
+            return {}
+        # goto next extractor
+        nodes.insert(0, node)
+        return None
+
+    def extract_list(self, nodes: list, key: str, label: str, extract):
+        first = nodes[0]
+        if not (self.name_of(first) == 'h4' and
+                self.string_of(first).lower().startswith(label.lower())):
+            return None
+        nodes.pop(0)
+
+        valid_nodes = []
+        while len(nodes) >= 1 and self.name_of(nodes[0]) == 'div':
+            valid_nodes.append(nodes.pop(0))
+        return {key: [extract(node) for node in valid_nodes]}
+
+    def parse_status(self, node):
+        text = self.string_of(self.select_one(node, 'span'))
+        matched = STATUS_PATTERN.match(text)
+        if matched is not None:
+            groups = matched.groups()
+            return (groups[0], int(groups[1]))
+        matched = ANY_PATTERN.match(text)
+        groups = matched.groups()
+        return (groups[0], None)
+
+    def parse_href(self, node):
+        path = self.attr_of(self.select_one(node, 'a'), 'href')
+        return id_from_url(path)
+
+
+def xpath_of_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+class LxmlCodexParser(CodexParser):
+    ''' Parse codex pages on lxml.html tree with precompiled XPath
+
+    Output is identical to `CodexParser`. Selectors follow the semantics of
+    BeautifulSoup `select`, which matches descendants of the node only.
+    '''
+
+    SELECTORS = {
+        ".codex-page":
+            etree.XPath(f"//*[{xpath_of_class('codex-page')}]"),
+        ".herotext":
+            etree.XPath(f"//*[{xpath_of_class('herotext')}]"),
+        ".codex-page-icon img":
+            etree.XPath(f"descendant-or-self::*[{xpath_of_class('codex-page-icon')}]//img"),
+        ".codex-page-tag":
+            etree.XPath(f".//*[{xpath_of_class('codex-page-tag')}]"),
+        ".codex-stat":
+            etree.XPath(f".//*[{xpath_of_class('codex-stat')}]"),
+        "span":
+            etree.XPath(".//span"),
+        "a":
+            etree.XPath(".//a"),
+    }
+    PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+    def load(self, html: str):
+        return lxml.html.document_fromstring(
+            html.encode('utf-8'), parser=self.PARSER)
+
+    def release(self, root) -> None:
+        root.clear()
+
+    def page_nodes(self, root) -> list:
+        page = self.select_one(root, ".codex-page")
+        return [
+            node for node in page
+            if isinstance(node.tag, str) and node.tag != 'hr'
+        ]
+
+    def select(self, node, selector: str) -> list:
+        return self.SELECTORS[selector](node)
+
+    def select_one(self, node, selector: str):
+        nodes = self.SELECTORS[selector](node)
+        return nodes[0] if len(nodes) >= 1 else None
+
+    def name_of(self, node) -> str:
+        return node.tag
+
+    def classes_of(self, node):
+        return node.get('class', '').split()
+
+    def attr_of(self, node, name: str) -> str:
+        return node.attrib[name]
+
+    def string_of(self, node):
+        ''' Same as `Tag.string`, the only string child of node if any '''
+        children = list(node)
+        if node.text:
+            if len(children) >= 1:
+                return None
+            return node.text
+        if len(children) != 1 or children[0].tail:
+            return None
+        child = children[0]
+        if isinstance(child.tag, str):
+            return self.string_of(child)
+        # comment or processing instruction
+        return child.text
+
+    def stripped_text_of(self, node) -> str:
+        return ''.join(
+            string.strip() for string in node.itertext() if string.strip())
+
+
+BACKENDS = {
+    "soup": CodexParser,
+    "lxml": LxmlCodexParser,
+}
+
+# Parsers of worker process by language, see `init_worker`
+WORKER_BACKEND = CodexParser
+WORKER_PARSERS = {}
+
+
+def init_worker(backend="soup"):
+    ''' Initializer of worker processes in the parsing pool '''
+    global WORKER_BACKEND  # pylint: disable=global-statement
+    WORKER_BACKEND = BACKENDS[backend]
+    WORKER_PARSERS.clear()
+
+
+def parse_in_worker(path: str, lang: str, html: str):
+    if lang not in WORKER_PARSERS:
+        WORKER_PARSERS[lang] = WORKER_BACKEND(lang)
+    return WORKER_PARSERS[lang].parse_item(path, html)
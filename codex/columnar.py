@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Columnar encoding of exported data of one language.
+
+Codexes are stored as columns instead of one object per codex, so keys are
+not repeated and repeated values are stored once. Decoding gives data equal
+to the JSON export, with the same key order.
+
+    format, version       "columnar", VERSION
+    keys                  keys of exported data in order
+    text, category, options, ...
+                          other sections same as JSON export
+    ids                   codex ids; a codex is referred by its position.
+                          First `count` ids are codexes in export order,
+                          the rest are ids referred but not exported
+    count                 number of codexes
+    shapes                distinct key lists of codexes
+    columns.shape         position in shapes of each codex
+    columns.{key}         values of codexes having the key, in codex order,
+                          as {"kind": kind, ...} by kind:
+        raw               "values": [value]
+        path              "values": [path or null], null is "/codex/{id}/"
+        dictionary        "values": [distinct value], "codes": [position]
+        dictionary_list   "values": [distinct value], "codes": [[position]]
+        status_list       "values": [distinct status],
+                          "codes": [[[position, probability]]]
+        reference         "codes": [[position in ids]]
+    relations             if exported, as JSON export with ids as positions,
+                          and reverse indexes as [[id, [id]]]
+'''
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+VERSION = 1
+
+KINDS = {
+    "path": "path",
+    "category": "dictionary",
+    "family": "dictionary",
+    "place": "dictionary",
+    "rarity": "dictionary",
+    "tier": "dictionary",
+    "useableBy": "dictionary",
+    "exotic": "dictionary",
+    "ornaguide_category": "dictionary",
+    "events": "dictionary_list",
+    "stats": "dictionary_list",
+    "tags": "dictionary_list",
+    "causes": "status_list",
+    "cures": "status_list",
+    "gives": "status_list",
+    "immunities": "status_list",
+    "dropped_by": "reference",
+    "drops": "reference",
+    "material_for": "reference",
+    "materials": "reference",
+    "spells": "reference",
+}
+
+
+class Interner:
+    ''' Distinct values by position of first use '''
+
+    def __init__(self, values=()) -> None:
+        self.values = []
+        self.positions = {}
+        for value in values:
+            self.code(value)
+
+    def code(self, value) -> int:
+        # keep True and 1 apart, they are equal as dict keys
+        key = (type(value), value)
+        position = self.positions.get(key)
+        if position is None:
+            position = self.positions[key] = len(self.values)
+            self.values.append(value)
+        return position
+
+
+def encode_column(kind, values, ids: Interner):
+    if kind == "raw":
+        return {"kind": kind, "values": values}
+    if kind == "path":
+        return {"kind": kind, "values": [
+            None if path == f"/codex/{ids.values[position]}/" else path
+            for position, path in values
+        ]}
+    if kind == "reference":
+        return {"kind": kind, "codes": [
+            [ids.code(id_) for id_ in value] for value in values]}
+    dictionary = Interner()
+    if kind == "dictionary":
+        codes = [dictionary.code(value) for value in values]
+    elif kind == "dictionary_list":
+        codes = [[dictionary.code(item) for item in value] for value in values]
+    elif kind == "status_list":
+        codes = [[[dictionary.code(status), probability]
+                  for status, probability in value] for value in values]
+    else:
+        raise ValueError(f"Unknown column kind '{kind}'.")
+    return {"kind": kind, "values": dictionary.values, "codes": codes}
+
+
+def decode_column(column, ids):
+    kind = column['kind']
+    if kind == "raw":
+        return column['values']
+    if kind == "path":
+        return column['values']
+    if kind == "reference":
+        return [[ids[code] for code in codes] for codes in column['codes']]
+    values = column['values']
+    if kind == "dictionary":
+        return [values[code] for code in column['codes']]
+    if kind == "dictionary_list":
+        return [[values[code] for code in codes] for codes in column['codes']]
+    if kind == "status_list":
+        return [[[values[code], probability] for code, probability in codes]
+                for codes in column['codes']]
+    raise ValueError(f"Unknown column kind '{kind}'.")
+
+
+def encode(data):
+    codexes = data['codex']
+    ids = Interner(codexes)
+    shapes = Interner()
+    shape_column = []
+    values = {}
+    for position, codex in enumerate(codexes.values()):
+        shape_column.append(shapes.code(tuple(codex)))
+        for key, value in codex.items():
+            if KINDS.get(key) == "path":
+                value = (position, value)
+            values.setdefault(key, []).append(value)
+    columns = {"shape": shape_column}
+    for key, column in values.items():
+        columns[key] = encode_column(KINDS.get(key, "raw"), column, ids)
+
+    encoded = {
+        "format": "columnar",
+        "version": VERSION,
+        "keys": list(data),
+        **{
+            key: value for key, value in data.items()
+            if key not in ("codex", "relations")
+        },
+        "ids": ids.values,
+        "count": len(codexes),
+        "shapes": [list(shape) for shape in shapes.values],
+        "columns": columns,
+    }
+    # relations are exported if asked
+    if "relations" in data:
+        encoded['relations'] = encode_relations(data['relations'], ids)
+    return encoded
+
+
+def encode_relations(relations, ids):
+    encoded = {
+        "statuses": {
+            status: {by: [ids.code(id_) for id_ in edges]
+                     for by, edges in by_key.items()}
+            for status, by_key in relations['statuses'].items()
+        },
+    }
+    for key, edges in relations.items():
+        if key == "statuses":
+            continue
+        encoded[key] = [
+            [ids.code(id_), [ids.code(source) for source in sources]]
+            for id_, sources in edges.items()
+        ]
+    return encoded
+
+
+def decode(encoded):
+    if encoded.get('format') != "columnar" or encoded['version'] != VERSION:
+        raise ValueError("Unsupported columnar data "
+                         f"version={encoded.get('version')}.")
+    ids = encoded['ids']
+    shapes = encoded['shapes']
+    columns = {
+        key: iter(decode_column(column, ids))
+        for key, column in encoded['columns'].items() if key != "shape"
+    }
+    codexes = {}
+    for position, shape in enumerate(encoded['columns']['shape']):
+        codex = {key: next(columns[key]) for key in shapes[shape]}
+        if "path" in codex and codex['path'] is None:
+            codex['path'] = f"/codex/{ids[position]}/"
+        codexes[ids[position]] = codex
+
+    decoded = {"codex": codexes}
+    if "relations" in encoded:
+        decoded['relations'] = decode_relations(encoded['relations'], ids)
+    return {
+        key: decoded[key] if key in decoded else encoded[key]
+        for key in encoded['keys']
+    }
+
+
+def decode_relations(encoded, ids):
+    relations = {}
+    for key, edges in encoded.items():
+        if key == "statuses":
+            relations[key] = {
+                status: {by: [ids[code] for code in codes]
+                         for by, codes in by_key.items()}
+                for status, by_key in edges.items()
+            }
+        else:
+            relations[key] = {
+                ids[code]: [ids[source] for source in sources]
+                for code, sources in edges
+            }
+    return relations
+
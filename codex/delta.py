@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Versioned manifest of exported data, and patches from the previous export.
+
+    delta/manifest.json     format of this export, and for each language its
+                            version, content hashes of sections and codexes,
+                            and the patch from the previous version if any
+    delta/{lang}.{from}-{to}.json
+                            patch from version `from` to `to`: added and
+                            changed codexes, removed codex ids, and changed
+                            keys of sections other than codex
+
+Version of a language is the content hash of its data, so a patch applies
+to the data it was made from only, whichever export built that data.
+Clients of other versions load the full data instead.
+
+Sections are hashed by key down to SECTION_DEPTH levels, and a patch of
+sections sends changed keys only, as a tree of
+
+    {"set": {key: value}, "unset": [key], "patch": {key: patch}}
+'''
+
+import json
+import logging
+import os
+from collections.abc import Mapping
+
+from utils import content_hash, write_json
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FORMAT = 1
+SECTION_DEPTH = 3
+
+
+def load_manifest(directory: str):
+    path = os.path.join(directory, "delta", "manifest.json")
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def hash_tree(value, depth=SECTION_DEPTH):
+    ''' Content hashes of value by key, down to `depth` levels of mappings '''
+    if depth == 0 or not isinstance(value, Mapping):
+        return content_hash(value)
+    return {key: hash_tree(item, depth - 1) for key, item in value.items()}
+
+
+def diff_tree(value, hashes, last_hashes):
+    ''' Patch from value of `last_hashes` to value of `hashes` '''
+    patch = {"set": {}, "unset": [], "patch": {}}
+    for key, digest in hashes.items():
+        last = last_hashes.get(key)
+        if last == digest:
+            continue
+        if isinstance(digest, dict) and isinstance(last, dict):
+            patch['patch'][key] = diff_tree(value[key], digest, last)
+        else:
+            patch['set'][key] = value[key]
+    patch['unset'] = [key for key in last_hashes if key not in hashes]
+    return {key: item for key, item in patch.items() if len(item) >= 1}
+
+
+def apply_tree(value, patch):
+    value = dict(value)
+    for key in patch.get('unset', ()):
+        del value[key]
+    value.update(patch.get('set', {}))
+    for key, item in patch.get('patch', {}).items():
+        value[key] = apply_tree(value[key], item)
+    return value
+
+
+def apply_patch(data, patch):
+    ''' Data of the next version, from data and its patch '''
+    codexes = dict(data['codex'])
+    for id_ in patch['removed']:
+        del codexes[id_]
+    codexes.update(patch['changed'])
+    codexes.update(patch['added'])
+    sections = apply_tree(
+        {key: value for key, value in data.items() if key != 'codex'},
+        patch['sections'])
+    # in order of data, sections added last
+    return {
+        key: codexes if key == 'codex' else sections[key]
+        for key in [*data, *sections] if key == 'codex' or key in sections
+    }
+
+
+class DeltaWriter:
+    def __init__(self, directory, previous=None, compact=False, compress=()):
+        self.directory = os.path.join(directory, "delta")
+        self.compact = compact
+        self.compress = compress
+        # read before this export overwrites it, when previous is directory
+        self.previous = load_manifest(previous or directory)
+        self.languages = {}
+
+    def write(self, lang, data):
+        ''' Hash data of a language, write patch from previous version '''
+        hashes = {id_: content_hash(codex)
+                  for id_, codex in data['codex'].items()}
+        sections = {key: value for key, value in data.items()
+                    if key != 'codex'}
+        section_hashes = hash_tree(sections)
+        version = content_hash([section_hashes, hashes])
+        self.languages[lang] = {
+            "version": version,
+            "sections": section_hashes,
+            "codexes": hashes,
+            "patch": None,
+        }
+
+        last = (self.previous or {}).get('languages', {}).get(lang)
+        if last is None:
+            logger.info("No previous export of lang=%s, skipped patch", lang)
+            return
+        if last['version'] == version:
+            logger.info("Unchanged lang=%s version=%s", lang, version)
+            return
+        last_hashes = last['codexes']
+        patch = {
+            "from": last['version'],
+            "to": version,
+            "added": {
+                id_: data['codex'][id_]
+                for id_ in hashes if id_ not in last_hashes
+            },
+            "changed": {
+                id_: data['codex'][id_]
+                for id_, digest in hashes.items()
+                if id_ in last_hashes and last_hashes[id_] != digest
+            },
+            "removed": [id_ for id_ in last_hashes if id_ not in hashes],
+            "sections": diff_tree(sections, section_hashes, last['sections']),
+        }
+        name = f"{lang}.{patch['from']}-{patch['to']}.json"
+        os.makedirs(self.directory, exist_ok=True)
+        size = write_json(os.path.join(self.directory, name), patch,
+                          compact=self.compact, compress=self.compress)
+        self.languages[lang]['patch'] = name
+        logger.info("Written patch lang=%s added=%d changed=%d removed=%d "
+                    "sections=%s bytes=%d", lang, len(patch['added']),
+                    len(patch['changed']), len(patch['removed']),
+                    ','.join(sorted({
+                        *patch['sections'].get('set', ()),
+                        *patch['sections'].get('patch', ()),
+                        *patch['sections'].get('unset', ()),
+                    })) or '-', size)
+
+    def write_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        write_json(os.path.join(self.directory, "manifest.json"), {
+            "format": FORMAT,
+            "languages": self.languages,
+        }, compact=self.compact)
+        logger.info("Written manifest languages=%s",
+                    ','.join(f"{lang}:{language['version']}"
+                             for lang, language in self.languages.items()))
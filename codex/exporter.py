@@ -1,13 +1,27 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import base64
+import hashlib
+import json
 import logging
 import os.path
 import re
 import sys
-
-from bs4 import BeautifulSoup, Tag
-from utils import TEXTS, HttpSession
+from collections import deque
+from concurrent.futures import (BrokenExecutor, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from datetime import datetime, timedelta
+
+from bs4 import BeautifulSoup
+from codex_parser import (CodexParser, id_from_url, init_worker,
+                          parse_in_worker)
+from record import CodexRecord
+from relations import RelationGraph
+from search import SearchIndex
+from telemetry import Telemetry
+from utils import (TEXTS, Checkpoint, HttpSession, ParseCache, SerialExecutor,
+                   cache_path, content_hash, write_json)
 
 logging.basicConfig(
     format="[%(asctime)s] %(levelname)s %(funcName)s:%(lineno)d %(message)s",
@@ -16,41 +30,108 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-
-def normalize(string: str):
-    string = string \
-        .replace('✓', '') \
-        .replace('★', '') \
-        .strip()
-    try:
-        return int(string)
-    except ValueError:
-        return string
+GUIDE_CATEGORIES = ("item", "skill", "pet", "monster")
+GUIDE_TIERS = range(1, 10 + 1)
+GUIDE_FILE = "ornaguide.json"
+GUIDE_EXPIRY = timedelta(hours=22)
+CATEGORY_LINK = re.compile(r'^/codex/(\w+)/$')
 
 
 class Exporter:
-    def __init__(self, index_path, lang):
+    def __init__(self, index_path, langs, workers=1, parse_cache=True,
+                 backend="soup", http_options=None, telemetry=None,
+                 resume=False, max_failures=0, quarantine_path=None,
+                 facets=False, relations=False):
         self.index_path = index_path
-        self.lang = lang
-        self.texts = TEXTS[lang]
-        self.http = HttpSession()
-        self.guide = {}
-        self.meta_rules = None
+        self.langs = langs
+        self.workers = workers or os.cpu_count()
+        self.backend = backend
+        # sections for clients filtering by bitmaps and by reverse indexes,
+        # off until one does
+        self.facets = facets
+        self.relations = relations
+        self.http = HttpSession(**(http_options or {}))
+        self.telemetry = telemetry or Telemetry()
+        self.telemetry.watch(self.http)
+        # a replayed run leaves caches and state of runs on disk as is
+        self.parse_cache = ParseCache(f"{CodexParser.VERSION}-{backend}") \
+            if parse_cache and not self.http.replay else None
+        self.resume = resume
+        self.checkpoint = Checkpoint("export_checkpoint.json",
+                                     enabled=not self.http.replay)
+        # pages failed to parse, skipped until more than max_failures
+        self.max_failures = max_failures
+        self.quarantine = []
+        self.quarantine_path = quarantine_path or cache_path("quarantine.json")
+        self.guide = None
+        self.guide_executor = None
+        self.guide_futures = {}
+        # a recorded run fetches orna.guide to archive it, a replayed run
+        # reads it from the archive only, so both skip the disk cache
+        self.guide_cache = self.http.archive is None
+        self.search_index = None
 
     def prepare(self):
-        for category in ("item", "skill", "pet", "monster"):
+        ''' Start fetching orna.guide in background, see `wait_guide` '''
+        if self.guide_cache:
+            self.guide = self.load_guide()
+        if self.guide is not None:
+            return
+        self.guide_executor = ThreadPoolExecutor(max_workers=8)
+        self.guide_futures = {
+            (category, tier): self.guide_executor.submit(
+                self.fetch_guide, category, tier)
+            for category in GUIDE_CATEGORIES
+            for tier in GUIDE_TIERS
+        }
+
+    def wait_guide(self):
+        ''' Build orna.guide table from fetched tiers '''
+        if self.guide is not None:
+            return
+        self.guide = {}
+        failures = 0
+        for category in GUIDE_CATEGORIES:
             items = []
-            for tier in range(1, 10 + 1):
-                items.extend(self.fetch_guide(category, tier))
+            for tier in GUIDE_TIERS:
+                future = self.guide_futures.get((category, tier))
+                if future is None:
+                    continue
+                try:
+                    items.extend(future.result())
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.error("Failed orna.guide action=%s tier=%s: %r",
+                                 category, tier, exc)
+                    failures += 1
             for item in items:
                 path = item.get('codex', None)
                 if path is None:
                     continue
                 if path in self.guide:
                     logger.error("codex duplicated path=%s", path)
-                self.guide[path] = item
-                item['category'] = category
-        logger.info("Prepared orna.guide items=%d", len(self.guide))
+                self.guide[path] = {"id": item['id'], "category": category}
+        if self.guide_executor is not None:
+            self.guide_executor.shutdown()
+        logger.info("Prepared orna.guide items=%d failures=%d",
+                    len(self.guide), failures)
+        # keep failed result out of disk, so next run fetches again
+        if self.guide_cache and len(self.guide_futures) >= 1 and failures == 0:
+            self.save_guide()
+
+    def load_guide(self):
+        path = cache_path(GUIDE_FILE)
+        if not os.path.exists(path):
+            return None
+        age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(path))
+        if age >= GUIDE_EXPIRY:
+            return None
+        with open(path, 'r', encoding='utf-8') as file:
+            guide = json.load(file)
+        logger.info("Loaded orna.guide items=%d age=%s", len(guide), age)
+        return guide
+
+    def save_guide(self):
+        write_json(cache_path(GUIDE_FILE), self.guide, compact=True)
 
     def fetch_guide(self, action, tier):
         logger.info("fetch orna.guide action=%s tier=%s", action, tier)
@@ -65,26 +146,44 @@ class Exporter:
         return resp.raise_for_status()
 
     def export(self):
-        logger.info("Exporting lang=%s", self.lang)
-        data = {}
-        data['text'] = self.texts
-        data['category'] = self.export_category()
-        data['codex'] = self.export_codexes()
-        self.add_causes_by_spells(data['codex'])
-        self.add_material_for(data['codex'])
-        data['options'] = self.export_options(data['codex'])
-        return data
-
-    def export_category(self):
+        ''' Export all languages, yield (lang, data) one by one
+
+        A codex is final only when all codexes of its language are parsed,
+        since post-passes add reverse edges to it from other codexes, so
+        data of a language is whole before it is yielded.
+        '''
+        with self.telemetry.stage("export_codexes"):
+            codexes = self.export_codexes()
+        with self.telemetry.stage("post-passes"):
+            self.search_index = SearchIndex.build(codexes)
+        for lang in self.langs:
+            logger.info("Exporting lang=%s", lang)
+            data = {}
+            data['text'] = TEXTS[lang]
+            with self.telemetry.stage("export_category"):
+                data['category'] = self.export_category(lang)
+            data['codex'] = codexes.pop(lang)
+            with self.telemetry.stage("post-passes"):
+                relations = self.export_relations(data['codex'])
+                data['options'] = self.export_options(data['codex'])
+                if self.facets:
+                    data['facets'] = self.export_facets(
+                        data['codex'], data['options'])
+                if self.relations:
+                    data['relations'] = relations
+            yield lang, data
+
+    def export_category(self, lang):
         logger.info("Exporting category")
 
-        resp = self.http.get_playorna_com("/codex/", self.lang)
+        resp = self.http.get_playorna_com("/codex/", lang)
         soup = BeautifulSoup(resp.text, "lxml")
         nodes = soup.select("a.codex-link")
         catetories = {
-            re.match(r'^/codex/(\w+)/$', node['href']).group(1): node.text.strip().title()
+            CATEGORY_LINK.match(node['href']).group(1): node.text.strip().title()
             for node in nodes
         }
+        soup.decompose()
 
         prefix = os.path.commonprefix(list(catetories.values()))
         catetories = {
@@ -94,30 +193,218 @@ class Exporter:
         return catetories
 
     def export_codexes(self):
-        logger.info("Exporting codexes")
+        ''' Export codexes of all languages, page by page '''
+        logger.info("Exporting codexes langs=%s", ','.join(self.langs))
         paths = []
         with open(self.index_path, 'r', encoding='utf-8') as file:
             for path in file.readlines():
                 paths.append(path.strip())
 
         logger.info("Codex index items=%d", len(paths))
-        codexes = {}
-        for path in paths:
-            resp = self.http.get_playorna_com(path, self.lang)
-            if resp.status_code != 200:
-                logger.warning("Skipped codex path=%s code=%s",
-                               path, resp.status_code)
-                continue
-
-            id_ = self.id_from_url(path)
+        codexes = {lang: {} for lang in self.langs}
+        # checkpoint is valid for same index, languages and parser only
+        key = content_hash([paths, self.langs, CodexParser.VERSION, self.backend])
+        # all languages of paths before done are collected
+        done = self.restore_checkpoint(key, paths, codexes) if self.resume else 0
+        positions = {path: position for position, path in enumerate(paths)}
+        if self.workers > 1:
+            logger.info("Parsing codexes with workers=%d", self.workers)
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=init_worker, initargs=(self.backend,))
+            # bound pages in flight so html does not pile up in memory
+            window = self.workers * 4
+        else:
+            init_worker(self.backend)
+            executor = SerialExecutor()
+            window = 1
+
+        def collect(entry):
+            nonlocal done
+            self.collect_codex(codexes, *entry)
+            done = positions[entry[0]]
+            if self.checkpoint.due():
+                self.save_checkpoint(key, done, codexes)
+
+        with executor:
+            pending = deque()
             try:
-                codexes[id_] = self.parse_item(path, resp.text)
-            except:
-                logger.error("id=%s", id_)
+                for path, lang, html in self.fetch_codexes(paths[done:]):
+                    pending.append(self.parse_codex(executor, path, lang, html))
+                    if len(pending) >= window:
+                        collect(pending.popleft())
+                while len(pending) >= 1:
+                    collect(pending.popleft())
+            except BaseException:
+                self.save_checkpoint(key, done, codexes)
                 raise
-
+            finally:
+                self.write_quarantine()
+        self.checkpoint.clear()
+        self.drop_quarantined(codexes)
+
+        self.wait_guide()
+        for lang_codexes in codexes.values():
+            for codex in lang_codexes.values():
+                self.add_guide(codex['path'], codex)
+
+        if self.parse_cache is not None:
+            evicted = self.parse_cache.evict(paths)
+            self.parse_cache.close()
+            logger.info("Parse cache hits=%d misses=%d evicted=%d",
+                        self.parse_cache.hits, self.parse_cache.misses,
+                        evicted)
         return codexes
 
+    def save_checkpoint(self, key, done, codexes):
+        if self.parse_cache is not None:
+            self.parse_cache.commit()
+        self.checkpoint.save({"key": key, "done": done, "codexes": codexes,
+                              "quarantine": self.quarantine})
+
+    def restore_checkpoint(self, key, paths, codexes) -> int:
+        ''' Load collected codexes, return number of paths to skip '''
+        state = self.checkpoint.load()
+        if state is None or state['key'] != key:
+            logger.info("No checkpoint to resume, export from start")
+            return 0
+        for lang, lang_codexes in state['codexes'].items():
+            for id_, codex in lang_codexes.items():
+                codexes[lang][id_] = CodexRecord(codex)
+        # pages from path done on are parsed again
+        skipped = set(paths[:state['done']])
+        self.quarantine = [failure for failure in state.get('quarantine', [])
+                           if failure['path'] in skipped]
+        logger.info("Resumed. Skipped paths=%d", state['done'])
+        return state['done']
+
+    def parse_codex(self, executor, path, lang, html):
+        ''' Parse page from cache or in executor, return pending entry '''
+        digest = None
+        if self.parse_cache is not None:
+            digest = self.parse_cache.digest(html)
+            codex = self.parse_cache.get(path, lang, digest)
+            if codex is not None:
+                future = Future()
+                future.set_result(codex)
+                return path, lang, None, None, future
+        # identifies the page snapshot in quarantine if it fails to parse
+        snapshot = hashlib.sha256(html.encode()).hexdigest()
+        future = executor.submit(parse_in_worker, path, lang, html)
+        return path, lang, digest, snapshot, future
+
+    def collect_codex(self, codexes, path, lang, digest, snapshot, future):
+        id_ = id_from_url(path)
+        try:
+            codex = future.result()
+        except BrokenExecutor:
+            raise
+        except Exception as error:  # pylint: disable=broad-except
+            self.quarantine_codex(path, lang, snapshot, error)
+            return
+        if digest is not None:
+            self.parse_cache.put(path, lang, digest, codex)
+        codexes[lang][id_] = CodexRecord(codex)
+
+    # keys of codex linking to other codexes
+    LINK_KEYS = ("dropped_by", "materials", "spells", "drops")
+
+    def drop_quarantined(self, codexes):
+        ''' Drop quarantined pages from all languages, and links to them
+
+        Clients read every linked codex in every loaded language, so a page
+        failed in one language is missing from all of them.
+        '''
+        ids = {id_from_url(failure['path']) for failure in self.quarantine}
+        if len(ids) == 0:
+            return
+        for lang_codexes in codexes.values():
+            for id_ in ids:
+                lang_codexes.pop(id_, None)
+            for codex in lang_codexes.values():
+                for key in self.LINK_KEYS:
+                    if key not in codex:
+                        continue
+                    links = tuple(link for link in codex[key]
+                                  if link not in ids)
+                    if len(links) == 0:
+                        del codex[key]
+                    elif len(links) != len(codex[key]):
+                        codex[key] = links
+        logger.warning("Dropped quarantined ids=%d from langs=%s: %s",
+                       len(ids), ','.join(codexes), ', '.join(sorted(ids)))
+
+    def quarantine_codex(self, path, lang, snapshot, error):
+        ''' Skip page failed to parse, abort if too many pages failed '''
+        logger.error("Quarantined id=%s lang=%s html_sha256=%s",
+                     id_from_url(path), lang, snapshot, exc_info=error)
+        self.quarantine.append({
+            "path": path,
+            "lang": lang,
+            "exception": f"{type(error).__name__}: {error}",
+            "html_sha256": snapshot,
+        })
+        if 0 <= self.max_failures < len(self.quarantine):
+            raise RuntimeError(
+                f"Failed to parse {len(self.quarantine)} pages, "
+                f"over max_failures={self.max_failures}") from error
+
+    def write_quarantine(self):
+        ''' Write report of pages failed to parse, empty if none failed '''
+        write_json(self.quarantine_path, self.quarantine)
+        if len(self.quarantine) >= 1:
+            logger.warning("Quarantined pages=%d report=%s: %s",
+                           len(self.quarantine), self.quarantine_path,
+                           ", ".join(f"{failure['path']}({failure['lang']})"
+                                     for failure in self.quarantine))
+
+    def fetch_codexes(self, paths):
+        ''' Fetch pages of all languages, yield (path, lang, html) '''
+        for path in paths:
+            for lang in self.langs:
+                resp = self.http.get_playorna_com(path, lang)
+                if resp.status_code != 200:
+                    logger.warning("Skipped codex path=%s lang=%s code=%s",
+                                   path, lang, resp.status_code)
+                    continue
+                yield path, lang, resp.text
+
+    # option type, codex key, and shape of codex value
+    OPTION_KEYS = (
+        # item.x is value directly
+        ('families', 'family', 'value'),
+        ('places', 'place', 'value'),
+        ('rarities', 'rarity', 'value'),
+        ('tiers', 'tier', 'value'),
+        ('useables', 'useableBy', 'value'),
+        # item.x is [value, value, ...]
+        ('events', 'events', 'list'),
+        ('tags', 'tags', 'list'),
+        # item.x is [[value, ...unused], ...]
+        ('statuses', 'causes', 'status'),
+        ('statuses', 'cures', 'status'),
+        ('statuses', 'gives', 'status'),
+        ('statuses', 'immunities', 'status'),
+    )
+
+    def option_values(self, item):
+        ''' Yield (type, key, value) of options of a codex '''
+        for to, fr, shape in self.OPTION_KEYS:
+            if fr not in item:
+                continue
+            if shape == 'value':
+                yield to, fr, item[fr]
+            elif shape == 'list':
+                for value in item[fr]:
+                    yield to, fr, value
+            else:
+                for values in item[fr]:
+                    yield to, fr, values[0]
+
+    def facet_of(self, to, fr):
+        ''' Facet of an option, statuses are filtered by key of codex '''
+        return fr if to == 'statuses' else to
+
     def export_options(self, codexes):
         logger.info("Exporting options")
         options = {
@@ -131,219 +418,59 @@ class Exporter:
             "useables": set(),
         }
         for _, item in codexes.items():
-            # item.x is value directly
-            for to, fr in [
-                ['families', 'family'],
-                ['places', 'place'],
-                ['rarities', 'rarity'],
-                ['tiers', 'tier'],
-                ['useables', 'useableBy'],
-            ]:
-                if fr not in item:
-                    continue
-                value = item[fr]
+            for to, _, value in self.option_values(item):
                 options[to].add(value)
-            # item.x is [value, value, ...]
-            for to, fr in [
-                ['events', 'events'],
-                ['tags', 'tags'],
-            ]:
-                if fr not in item:
-                    continue
-                for value in item[fr]:
-                    options[to].add(value)
-            # item.x is [[value, ...unused], ...]
-            for to, fr in [
-                ['statuses', 'causes'],
-                ['statuses', 'cures'],
-                ['statuses', 'gives'],
-                ['statuses', 'immunities'],
-            ]:
-                if fr not in item:
-                    continue
-                for values in item[fr]:
-                    value = values[0]
-                    options[to].add(value)
         return {
             key: sorted(values)
             for key, values in options.items()
         }
 
-    def id_from_url(self, path: str):
-        return re.match(r"/codex/(\w+?/[\w-]+?)/", path).group(1)
-
-    def category_from_url(self, path: str):
-        return re.match(r"/codex/(\w+?)/[\w-]+?/", path).group(1)
-
-    def parse_item(self, path: str, html: str):
-        soup = BeautifulSoup(html, "lxml")
-        codex = {
-            "name": self.extract_name(soup),
-            "path": path,
-            "category": self.category_from_url(path),
-        }
-
-        # codex page
-        extractors = iter([
-            (self.extract_info,),
-            (self.extract_list,
-             "causes", self.texts["causes"], self.parse_status),
-            (self.extract_list,
-             "cures", self.texts["cures"], self.parse_status),
-            (self.extract_list,
-             "gives", self.texts["gives"], self.parse_status),
-            (self.extract_list,
-             "immunities", self.texts["immunities"], self.parse_status),
-            (self.extract_list,
-             "dropped_by", self.texts["droppedBy"], self.parse_href),
-            (self.extract_list,
-             "materials", self.texts["materials"], self.parse_href),
-            (self.extract_list,
-             "spells", self.texts["skills"], self.parse_href),
-            (self.extract_list,
-             "drops", self.texts["drops"], self.parse_href),
-        ])
-        nodes = list(filter(
-            lambda node: isinstance(node, Tag) and node.name != 'hr',
-            soup.select_one(".codex-page").children))
+    def export_facets(self, codexes, options):
+        ''' Codexes of each option value, for filtering by intersection
+
+        Facets are option types, except statuses which have a facet for each
+        of causes, cures, gives and immunities, as filters of clients. Entries
+        of a facet are in the same order as its options. Codexes of a value
+        are a bitmap over sorted codex ids, bit i (byte i // 8, least
+        significant bit first) set for ids[i], encoded in base64.
+        '''
+        logger.info("Exporting facets")
+        ids = sorted(codexes)
+        masks = {}
+        for key, values in options.items():
+            for to, fr, _ in self.OPTION_KEYS:
+                if to == key:
+                    masks.setdefault(self.facet_of(to, fr),
+                                     {value: 0 for value in values})
+        for position, id_ in enumerate(ids):
+            for to, fr, value in self.option_values(codexes[id_]):
+                masks[self.facet_of(to, fr)][value] |= 1 << position
+        size = (len(ids) + 7) // 8
+        facets = {"ids": ids}
+        for key, values in masks.items():
+            facets[key] = [
+                {
+                    "value": value,
+                    "count": bin(mask).count('1'),
+                    "bitmap": base64.b64encode(
+                        mask.to_bytes(size, 'little')).decode('ascii'),
+                }
+                for value, mask in values.items()
+            ]
+        return facets
 
-        try:
-            extract, *extract_args = next(extractors)
-            while len(nodes) >= 1:
-                ret = extract(nodes, *extract_args)
-                if ret is not None:
-                    codex.update(ret)
-                else:
-                    extract, *extract_args = next(extractors)
-        except StopIteration:
-            pass
-
-        # orna.guide
+    def add_guide(self, path: str, codex):
         guide = self.guide.get(path)
         if guide is not None:
             codex.update({
                 "ornaguide_id": guide['id'],
                 "ornaguide_category": guide['category'],
             })
-
-        # cleanup
-        for key, value in tuple(codex.items()):
-            if value is None:
-                del codex[key]
-            if isinstance(value, (str, list, tuple)) and len(value) == 0:
-                del codex[key]
-
         return codex
 
-    def add_material_for(self, codexes):
-        logger.info("Exporting codex: Adding material for")
-        for id_, item in codexes.items():
-            if 'materials' not in item:
-                continue
-            for target_id in item['materials']:
-                target = codexes[target_id]
-                if 'material_for' not in target:
-                    target['material_for'] = []
-                target['material_for'].append(id_)
-
-    def add_causes_by_spells(self, codexes):
-        logger.info("Exporting codex: Adding causes by spells")
-        for _, item in codexes.items():
-            if 'spells' not in item:
-                continue
-            causes = {}
-            for target_id in item['spells']:
-                if target_id not in codexes:
-                    logger.warning("Unknown spell: %s", target_id)
-                    continue
-                target = codexes[target_id]
-                if 'causes' not in target:
-                    continue
-                for [status, probability] in target['causes']:
-                    current = causes.get(status, {
-                        'probability': 0,
-                        'by': [],
-                    })
-                    current['by'].append(f"{target['name']} ({probability}%)")
-                    if probability > current['probability']:
-                        current['probability'] = probability
-                    causes[status] = current
-            if len(causes) >= 1:
-                item['causes_by_spells'] = causes
-
-    def extract_name(self, soup: BeautifulSoup):
-        return str(soup.select_one(".herotext").string)
-
-    def extract_info(self, nodes: list[Tag]):
-        node = nodes.pop(0)
-        classes = node.get('class', tuple())
-        # image
-        sub = node.select_one('.codex-page-icon img')
-        if sub is not None:
-            return {'image_url': sub['src']}
-        # tags
-        subs = node.select('.codex-page-tag')
-        if len(subs) >= 1:
-            return {'tags': [normalize(e.string) for e in subs]}
-        # stats
-        subs = node.select('.codex-stat')
-        if len(subs) >= 1:
-            return {'stats': [normalize(e.string) for e in subs]}
-        # meta
-        if self.meta_rules is None:
-            self.meta_rules = [
-                (key, re.compile(f"^({self.texts[key]})$"), lambda s: True)
-                for key in ['exotic']
-            ] + [
-                (key, re.compile(f"^{self.texts[key]}: *(.+)$"), None)
-                for key in ["family", "place", "rarity", "tier", "useableBy"]
-            ] + [
-                ('events', re.compile(f"^{self.texts['event']}: *(.+)$"),
-                 lambda string: sorted([normalize(s) for s in string.split('/')])),
-            ]
-        if 'codex-page-description' in classes or 'codex-page-meta' in classes:
-            string = ''.join(node.stripped_strings)
-            # meta
-            for key, pattern, parse in self.meta_rules:
-                matched = re.match(pattern, string)
-                if matched is None:
-                    continue
-                if parse is None:
-                    parse = normalize
-                return {key: parse(matched.group(1))}
-            # description
-            if 'codex-page-description' in classes:
-                return {'description': string}
-            logging.warning("Unknown meta node: %s", node)
-        # bypass until h4
-        if node.name != 'h4':
-            return {}
-        # goto next extractor
-        nodes.insert(0, node)
-        return None
-
-    def extract_list(self, nodes: list[Tag], key: str, label: str, extract):
-        first = nodes[0]
-        if not (first.name == 'h4' and
-                first.string.lower().startswith(label.lower())):
-            return None
-        nodes.pop(0)
-
-        valid_nodes = []
-        while len(nodes) >= 1 and nodes[0].name == 'div':
-            valid_nodes.append(nodes.pop(0))
-        return {key: [extract(node) for node in valid_nodes]}
-
-    def parse_status(self, node: Tag):
-        text = node.select_one('span').string
-        matched = re.match(r'^(.+) \((\d+)%\)$', text)
-        if matched is not None:
-            groups = matched.groups()
-            return (groups[0], int(groups[1]))
-        matched = re.match(r'^(.+)$', text)
-        groups = matched.groups()
-        return (groups[0], None)
-
-    def parse_href(self, node: Tag):
-        path = node.select_one('a')['href']
-        return self.id_from_url(path)
+    def export_relations(self, codexes):
+        ''' Add reverse edges to codexes, return reverse indexes '''
+        logger.info("Exporting relations")
+        graph = RelationGraph(codexes)
+        graph.apply()
+        return graph.to_json()
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import hashlib
+import json
 import logging
+import os
 import re
 import sys
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import requests
 from bs4 import BeautifulSoup
-from utils import HttpSession
+from telemetry import Telemetry
+from utils import Checkpoint, HttpSession, cache_path
 
 logging.basicConfig(
     format="[%(asctime)s] %(levelname)s %(funcName)s:%(lineno)d %(message)s",
@@ -18,78 +24,299 @@ logger.setLevel(logging.INFO)
 
 
 class Indexer:
-    def __init__(self, path, categories, lang="en") -> None:
-        logger.info("Initiate with path=%s lang=%s", path, lang)
+    def __init__(self, path, categories, lang="en",
+                 concurrency=1, incremental=False, http_options=None,
+                 telemetry=None, resume=False, recheck=200) -> None:
+        logger.info("Initiate with path=%s lang=%s concurrency=%d "
+                    "incremental=%s recheck=%d", path, lang, concurrency,
+                    incremental, recheck)
         self.path = path
         self.categories = categories
         self.lang = lang
-        self.http = HttpSession()
+        self.concurrency = concurrency
+        self.incremental = incremental
+        # number of known pages fetched again by incremental crawl, in turn
+        self.recheck = recheck
+        self.recheck_offset = 0
+        self.http = HttpSession(**(http_options or {}),
+                                pool_size=max(concurrency, 10))
+        # content digests of codex pages, from last run and this run, not
+        # saved by a replayed run which leaves state of runs on disk as is
+        self.state_path = None if self.http.replay \
+            else cache_path("index_state.json")
+        self.last_digests = {}
+        self.digests = {}
         self.known = set()
-        self.queue = []
+        self.queue = deque()
+        self.enqueued = set()
+        self.dedupe_hits = 0
+        # responses of listing pages fetched by bootstrap, by path
+        self.prefetched = {}
+        self.resume = resume
+        self.checkpoint = Checkpoint("index_checkpoint.json",
+                                     enabled=not self.http.replay)
+        self.http.reporters.append(self.report)
+        self.telemetry = telemetry or Telemetry()
+        self.telemetry.watch(self.http)
         self.is_codex = re.compile(r'^/codex/[^/]+/[^/]+/')
 
     def bootstrap(self) -> None:
         logger.info("Bootstrap from category pages")
-        for category in self.categories:
-            # limit max page number in case of infinite loop
-            for page_no in range(1, 10000):
-                path = f"/codex/{category}/?p={page_no}"
-                resp = self.http.get_playorna_com(path, self.lang)
-                if resp.status_code == 404:
-                    break
-                self.queue.append(path)
+        # one worker by category, the rate limiter throttles requests
+        with ThreadPoolExecutor(
+                max_workers=max(len(self.categories), 1)) as executor:
+            counts = list(executor.map(self.count_pages, self.categories))
+        for category, (count, fetched) in zip(self.categories, counts):
+            logger.info("Found pages=%d category=%s", count, category)
+            self.prefetched.update(fetched)
+            for page_no in range(1, count + 1):
+                self.enqueue(f"/codex/{category}/?p={page_no}")
         logger.info("Bootstraped. Queue length %d", len(self.queue))
 
+    def count_pages(self, category: str):
+        ''' Find number of listing pages by exponential then binary search
+
+        Pages are numbered from 1 without gaps, so page N exists if and only
+        if N <= count. Return count and responses of the existing pages
+        fetched during search, which are processed later in the crawl.
+        '''
+        fetched = {}
+
+        def exists(page_no: int) -> bool:
+            path = f"/codex/{category}/?p={page_no}"
+            resp = self.http.get_playorna_com(path, self.lang)
+            if resp.status_code == 404:
+                return False
+            fetched[path] = resp
+            return True
+
+        # limit max page number in case of infinite loop
+        limit = 10000
+        if not exists(1):
+            return 0, fetched
+        low, high = 1, 2
+        while high < limit and exists(high):
+            low, high = high, min(high * 2, limit)
+        # page low exists, page high does not or is over the limit
+        while high - low > 1:
+            middle = (low + high) // 2
+            if exists(middle):
+                low = middle
+            else:
+                high = middle
+        return low, fetched
+
     def load(self) -> None:
         logger.info("Load saved into queue")
         with open(self.path, 'r', encoding='utf-8') as fd:
             for path in fd.readlines():
-                self.queue.append(path.strip())
+                self.enqueue(path.strip())
         logger.info("Loaded. Queue length %d", len(self.queue))
 
+    def load_known(self) -> None:
+        ''' Load saved as known paths, without fetching them again '''
+        logger.info("Load saved as known")
+        with open(self.path, 'r', encoding='utf-8') as fd:
+            paths = [path.strip() for path in fd.readlines()]
+        self.known.update(path for path in paths if path)
+        self.enqueued.update(self.known)
+        logger.info("Loaded. Known paths %d", len(self.known))
+
+    def enqueue_recheck(self) -> None:
+        ''' Queue next `recheck` known paths, from where last run stopped '''
+        paths = sorted(self.known)
+        count = min(self.recheck, len(paths))
+        start = self.recheck_offset % len(paths) if paths else 0
+        for index in range(start, start + count):
+            self.queue.append(paths[index % len(paths)])
+        self.recheck_offset = start + count
+        logger.info("Recheck known paths=%d from=%d", count, start)
+
+    def enqueue(self, path: str) -> None:
+        ''' Add path to queue unless it has been queued before '''
+        if path in self.enqueued:
+            self.dedupe_hits += 1
+            return
+        self.enqueued.add(path)
+        self.queue.append(path)
+
+    def report(self) -> dict:
+        return {"queue": len(self.queue), "dedupe_hits": self.dedupe_hits}
+
     def save(self) -> None:
         logger.info("Save known paths")
         with open(self.path, 'w', encoding='utf-8') as fd:
             fd.write('\n'.join(sorted(self.known)))
 
+    def load_state(self) -> None:
+        if self.state_path is None or not os.path.exists(self.state_path):
+            logger.info("No saved state, crawl all pages")
+            return
+        with open(self.state_path, 'r', encoding='utf-8') as fd:
+            state = json.load(fd)
+        self.last_digests = state['digests']
+        self.recheck_offset = state.get('offset', 0)
+        logger.info("Loaded state of pages=%d", len(self.last_digests))
+
+    def save_state(self) -> None:
+        if self.state_path is None:
+            return
+        unchanged = sum(
+            1 for path, digest in self.digests.items()
+            if self.last_digests.get(path) == digest)
+        new = sum(1 for path in self.digests if path not in self.last_digests)
+        logger.info("Save state. Pages fetched=%d unchanged=%d changed=%d "
+                    "new=%d", len(self.digests), unchanged,
+                    len(self.digests) - unchanged - new, new)
+        # pages not fetched this run keep their last digests
+        digests = {**self.last_digests, **self.digests}
+        with open(self.state_path, 'w', encoding='utf-8') as fd:
+            json.dump({
+                "offset": self.recheck_offset,
+                "digests": {
+                    path: digest for path, digest in sorted(digests.items())
+                    if path in self.known
+                },
+            }, fd, indent=0)
+
     def check_page(self, path: str, resp: requests.Response) -> None:
         ''' Check whether a path is valid codex path '''
         # Keep all pages except 404 in known paths
         if resp.status_code == 404:
             logger.warning("Page path=%s is missing.", path)
+            self.known.discard(path)
             return
         if self.is_codex.match(path):
             self.known.add(path)
 
-    def parse_page(self, path: str, resp: requests.Response) -> None:
-        ''' Add codex links from the page to queue '''
+    def find_links(self, path: str, resp: requests.Response) -> list[str]:
+        ''' Find codex links from the page '''
         # Parse pages with status code 200 only
         if resp.status_code != 200:
             logger.warning("Page path=%s return unknown status code=%d.",
                            path, resp.status_code)
-            return
+            return []
+        # Links of unchanged codex pages are in the index already
+        if self.incremental and self.is_codex.match(path):
+            digest = hashlib.sha256(resp.content).hexdigest()
+            self.digests[path] = digest
+            if self.last_digests.get(path) == digest:
+                logger.debug("Unchanged path=%s", path)
+                return []
         soup = BeautifulSoup(resp.text, "lxml")
+        links = []
         for item in soup.find_all("a", href=self.is_codex):
-            path = item['href']
-            logger.debug("Found path=%s", path)
-            self.queue.append(path)
+            logger.debug("Found path=%s", item['href'])
+            links.append(item['href'])
+        soup.decompose()
+        return links
+
+    def parse_page(self, path: str, resp: requests.Response) -> None:
+        ''' Add codex links from the page to queue '''
+        for link in self.find_links(path, resp):
+            self.enqueue(link)
+
+    def get_page(self, path: str) -> requests.Response:
+        response = self.prefetched.pop(path, None)
+        if response is not None:
+            return response
+        return self.http.get_playorna_com(path, self.lang)
+
+    def fetch_page(self, path: str):
+        ''' Fetch and parse a page in worker thread '''
+        response = self.get_page(path)
+        return response, self.find_links(path, response)
 
     def consume_queue(self) -> None:
-        while len(self.queue) >= 1:
-            path = self.queue.pop(0)
-            if path in self.known:
-                continue
-            logger.info("Process path=%s", path)
-            response = self.http.get_playorna_com(path, self.lang)
-            self.check_page(path, response)
-            self.parse_page(path, response)
+        if self.concurrency > 1:
+            self.consume_queue_concurrently()
+            return
+        path = None
+        try:
+            while len(self.queue) >= 1:
+                path = self.queue.popleft()
+                logger.info("Process path=%s", path)
+                response = self.get_page(path)
+                self.check_page(path, response)
+                self.parse_page(path, response)
+                path = None
+                if self.checkpoint.due():
+                    self.save_checkpoint()
+        except BaseException:
+            self.save_checkpoint([path] if path is not None else [])
+            raise
+
+    def consume_queue_concurrently(self) -> None:
+        ''' Process queue with at most `concurrency` pages in flight '''
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = {}
+            try:
+                while len(self.queue) >= 1 or len(pending) >= 1:
+                    while len(self.queue) >= 1 and len(pending) < self.concurrency:
+                        path = self.queue.popleft()
+                        logger.info("Process path=%s", path)
+                        pending[executor.submit(self.fetch_page, path)] = path
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        path = pending[future]
+                        response, links = future.result()
+                        self.check_page(path, response)
+                        for link in links:
+                            self.enqueue(link)
+                        del pending[future]
+                    if self.checkpoint.due():
+                        self.save_checkpoint(pending.values())
+            except BaseException:
+                self.save_checkpoint(pending.values())
+                raise
+
+    def save_checkpoint(self, in_flight=()) -> None:
+        ''' Save crawl state, with pages in flight back in queue '''
+        self.checkpoint.save({
+            "lang": self.lang,
+            "queue": [*in_flight, *self.queue],
+            "enqueued": sorted(self.enqueued),
+            "known": sorted(self.known),
+            "digests": dict(self.digests),
+            "offset": self.recheck_offset,
+        })
+
+    def restore_checkpoint(self) -> bool:
+        state = self.checkpoint.load()
+        if state is None or state['lang'] != self.lang:
+            logger.info("No checkpoint to resume, crawl from start")
+            return False
+        self.queue = deque(state['queue'])
+        self.enqueued = set(state['enqueued'])
+        self.known = set(state['known'])
+        self.digests = state['digests']
+        self.recheck_offset = state.get('offset', 0)
+        logger.info("Resumed. Queue length %d known %d",
+                    len(self.queue), len(self.known))
+        return True
 
     def run(self) -> None:
         logger.info("Run with lang=%s", self.lang)
 
-        self.load()
-        self.bootstrap()
-        self.consume_queue()
-        self.save()
+        with self.telemetry.stage("bootstrap"):
+            if self.incremental:
+                self.load_state()
+            if not (self.resume and self.restore_checkpoint()):
+                # incremental crawl fetches listing pages, new pages and
+                # some known pages in turn, instead of all known pages
+                if self.incremental:
+                    self.load_known()
+                    self.bootstrap()
+                    self.enqueue_recheck()
+                else:
+                    self.load()
+                    self.bootstrap()
+        with self.telemetry.stage("crawl"):
+            self.consume_queue()
+        with self.telemetry.stage("write"):
+            self.save()
+            if self.incremental:
+                self.save_state()
+            self.checkpoint.clear()
 
         logger.info("Done with lang=%s", self.lang)
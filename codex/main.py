@@ -3,37 +3,100 @@
 # pylint: disable=import-outside-toplevel
 
 import argparse
-import json
 import os
 
 INDEX_FILE = "./data/playorna.com.txt"
+CATEGORIES = ("items", "monsters", "bosses", "followers", "raids", "spells")
 
 
-def update_index():
+def http_options(args):
+    from utils import ResponseArchive
+    options = {
+        "rate_limit": args.rate_limit,
+        "global_rate_limit": args.global_rate_limit,
+        "timeout": args.timeout,
+        "retries": args.retries,
+    }
+    if args.replay:
+        options["archive"] = ResponseArchive.load(args.replay)
+        options["replay"] = True
+    elif args.record:
+        options["archive"] = ResponseArchive(args.record)
+    return options
+
+
+def update_index(args, options, telemetry):
     from indexer import Indexer
     indexer = Indexer(
         path=INDEX_FILE,
-        categories=("items", "monsters", "bosses",
-                    "followers", "raids", "spells"),
+        categories=CATEGORIES,
         lang="en",
+        concurrency=args.concurrency,
+        incremental=args.incremental,
+        recheck=args.recheck,
+        http_options=options,
+        telemetry=telemetry,
+        resume=args.resume,
     )
     indexer.run()
 
 
-def export(directory, langs):
+def export(args, options, telemetry):
+    import columnar
+    from delta import DeltaWriter
     from exporter import Exporter
-    os.makedirs(directory, exist_ok=True)
-    if not os.path.isdir(directory):
-        raise FileNotFoundError(f"'{directory}' is not a directory.")
+    from shards import ShardWriter
+    from utils import check_compressions, write_json
+    directory = args.export
+    # data fetched by URL at runtime, not bundled with the application
+    assets = args.assets or directory
+    for path in (directory, assets):
+        os.makedirs(path, exist_ok=True)
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"'{path}' is not a directory.")
 
-    for lang in langs:
-        exporter = Exporter(INDEX_FILE, lang)
+    compress = [ext for ext in args.compress.split(',') if ext]
+    check_compressions(compress)
+
+    exporter = Exporter(
+        INDEX_FILE, args.langs.split(','),
+        workers=args.workers,
+        parse_cache=not args.no_parse_cache,
+        backend=args.parser,
+        http_options=options,
+        telemetry=telemetry,
+        resume=args.resume,
+        max_failures=args.max_failures,
+        facets=args.facets,
+        relations=args.relations,
+        quarantine_path=args.quarantine,
+    )
+    with telemetry.stage("prepare"):
         exporter.prepare()
-        data = exporter.export()
-        with open(
-            os.path.join(directory, f"{lang}.json"), 'w', encoding='utf-8',
-        ) as file:
-            file.write(json.dumps(data, indent=2, ensure_ascii=False))
+    shard_writer = ShardWriter(directory, args.compact, compress) \
+        if args.shards else None
+    delta_writer = DeltaWriter(assets, args.previous, args.compact,
+                               compress) if args.delta else None
+    # data is streamed to disk, but built whole by post-passes of a language
+    for lang, data in exporter.export():
+        with telemetry.stage("write"):
+            write_json(os.path.join(directory, f"{lang}.json"), data,
+                       compact=args.compact, compress=compress)
+            if args.columnar:
+                write_json(os.path.join(directory, f"{lang}.columnar.json"),
+                           columnar.encode(data), compact=args.compact,
+                           compress=compress)
+            if shard_writer is not None:
+                shard_writer.write(lang, data)
+            if delta_writer is not None:
+                delta_writer.write(lang, data)
+    with telemetry.stage("write"):
+        if shard_writer is not None:
+            shard_writer.write_manifest()
+        if delta_writer is not None:
+            delta_writer.write_manifest()
+        exporter.search_index.write(os.path.join(assets, "search.json"),
+                                    compact=args.compact, compress=compress)
 
 
 def main():
@@ -41,13 +104,75 @@ def main():
     parser.add_argument('--index', action='store_true')
     parser.add_argument('--export', metavar='DIR')
     parser.add_argument('--langs', metavar='LANG[,LANG,...]')
+    parser.add_argument('--concurrency', metavar='N', type=int, default=1,
+                        help="number of pages fetched in parallel by --index")
+    parser.add_argument('--rate-limit', metavar='RPS', type=float, default=10,
+                        help="max requests per second to each host, 0 for unlimited")
+    parser.add_argument('--global-rate-limit', metavar='RPS', type=float, default=0,
+                        help="max requests per second to all hosts, 0 for unlimited")
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=30,
+                        help="timeout of connecting and reading each response")
+    parser.add_argument('--retries', metavar='N', type=int, default=3,
+                        help="retries of timeouts, connection errors, 429 and 5xx")
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument('--record', metavar='ARCHIVE',
+                         help="save all responses of this run to a zip archive")
+    archive.add_argument('--replay', metavar='ARCHIVE',
+                         help="serve all requests from a recorded archive, without network")
+    parser.add_argument('--incremental', action='store_true',
+                        help="fetch listing pages, new pages and --recheck known pages "
+                             "only in --index")
+    parser.add_argument('--recheck', metavar='N', type=int, default=200,
+                        help="number of known pages fetched again in turn by --incremental")
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help="number of processes parsing pages in --export, 0 for all cores")
+    parser.add_argument('--parser', choices=('soup', 'lxml'), default='soup',
+                        help="backend parsing codex pages in --export")
+    parser.add_argument('--compact', action='store_true',
+                        help="write JSON without indent in --export")
+    parser.add_argument('--compress', metavar='gz|br[,...]', default='',
+                        help="also write precompressed copies in --export")
+    parser.add_argument('--columnar', action='store_true',
+                        help="also write data in columnar encoding in --export")
+    parser.add_argument('--facets', action='store_true',
+                        help="add bitmaps of codexes having each option value to --export data")
+    parser.add_argument('--relations', action='store_true',
+                        help="add reverse indexes of statuses, drops, materials and spells "
+                             "to --export data")
+    parser.add_argument('--shards', action='store_true',
+                        help="also write data sharded by category in --export")
+    parser.add_argument('--delta', action='store_true',
+                        help="also write codex hashes and patch from previous export in --assets")
+    parser.add_argument('--previous', metavar='DIR',
+                        help="directory of previous export for --delta, default to --assets DIR")
+    parser.add_argument('--assets', metavar='DIR',
+                        help="directory of search index and --delta output of --export, "
+                             "default to --export DIR")
+    parser.add_argument('--no-parse-cache', action='store_true',
+                        help="parse every page in --export, ignoring cached results")
+    parser.add_argument('--max-failures', metavar='N', type=int, default=0,
+                        help="skip up to N pages failing to parse in --export, -1 for no limit")
+    parser.add_argument('--quarantine', metavar='FILE',
+                        help="write pages failed to parse as JSON, "
+                             "default to quarantine.json in cache")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue --index and --export from checkpoints of a failed run")
+    parser.add_argument('--report', metavar='FILE',
+                        help="write wall, CPU, requests and memory of each stage as JSON")
+    parser.add_argument('--profile', metavar='DIR',
+                        help="write cProfile stats of each stage to DIR/{stage}.prof")
     args = parser.parse_args()
 
+    from telemetry import Telemetry
+    telemetry = Telemetry(args.profile)
+    options = http_options(args)
     if args.index:
-        update_index()
+        update_index(args, options, telemetry)
     if args.export:
-        langs = args.langs.split(',')
-        export(args.export, langs)
+        export(args, options, telemetry)
+    if args.record:
+        options["archive"].save()
+    telemetry.finish(args.report)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Compact record of a parsed codex.
+
+A codex is kept for every page of every language until export ends, so it is
+stored in slots instead of a dict, with its keys as a tuple shared by all
+records of the same shape, lists as tuples and repeated strings interned.
+It behaves as a mutable mapping keeping insertion order like the dict it
+replaces, and serializes to the same JSON.
+'''
+
+import sys
+from collections.abc import Mapping, MutableMapping
+
+# Keys of codex stored in slots, others are kept in a dict
+KEYS = (
+    "name", "path", "category", "image_url", "description",
+    "tags", "stats", "exotic", "family", "place", "rarity", "tier",
+    "useableBy", "events", "causes", "cures", "gives", "immunities",
+    "dropped_by", "materials", "spells", "drops",
+    "ornaguide_id", "ornaguide_category", "causes_by_spells", "material_for",
+)
+SLOTS = frozenset(KEYS)
+
+# Values of these keys repeat over codexes, and are interned
+INTERNED = frozenset((
+    "category", "family", "place", "rarity", "useableBy", "tags", "events",
+    "causes", "cures", "gives", "immunities",
+    "dropped_by", "materials", "spells", "drops", "ornaguide_category",
+))
+
+# Key tuples by themselves, shared by records of same shape
+SHAPES = {}
+
+
+def shape_of(keys: tuple) -> tuple:
+    return SHAPES.setdefault(keys, keys)
+
+
+def compact_value(value, interned=False):
+    ''' Lists as tuples, which are smaller, and strings interned if asked '''
+    if isinstance(value, str):
+        return sys.intern(value) if interned else value
+    if isinstance(value, (list, tuple)):
+        return tuple(compact_value(item, interned) for item in value)
+    return value
+
+
+def json_default(value):
+    ''' `default` of JSON encoders, serializing records as objects '''
+    if isinstance(value, Mapping):
+        return dict(value.items())
+    raise TypeError(
+        f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class CodexRecord(MutableMapping):
+    __slots__ = ("_keys", "_extra") + KEYS
+
+    def __init__(self, codex) -> None:
+        self._keys = ()
+        self._extra = None
+        for key, value in codex.items():
+            self[key] = compact_value(value, key in INTERNED)
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if key in SLOTS:
+            return getattr(self, key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value) -> None:
+        if key not in self._keys:
+            self._keys = shape_of(self._keys + (key,))
+        if key in SLOTS:
+            setattr(self, key, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __delitem__(self, key) -> None:
+        if key not in self._keys:
+            raise KeyError(key)
+        self._keys = shape_of(tuple(k for k in self._keys if k != key))
+        if key in SLOTS:
+            delattr(self, key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys
+
+    def __repr__(self) -> str:
+        return f"CodexRecord({dict(self.items())!r})"
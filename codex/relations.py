@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Relations between codexes of one language.
+
+Edges are collected in one pass over codexes, then reverse edges are added
+to codexes (`causes_by_spells`, `material_for`) and reverse indexes are
+emitted for the client:
+
+    statuses        {status: {"causes"|"cures"|"gives"|"immunities": [id]}}
+    dropped_by      {id: [id]}    codexes dropping the item
+    material_for    {id: [id]}    codexes upgraded with the item
+    used_by         {id: [id]}    codexes having the spell
+
+Edges to ids missing from codexes are dropped and counted.
+'''
+
+import logging
+import sys
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STATUS_KEYS = ("causes", "cures", "gives", "immunities")
+
+
+class RelationGraph:
+    def __init__(self, codexes) -> None:
+        self.codexes = codexes
+        self.statuses = {}
+        self.reverse = {
+            "dropped_by": {},
+            "material_for": {},
+            "used_by": {},
+        }
+        self.dangling = Counter()
+        for id_, codex in codexes.items():
+            for key in STATUS_KEYS:
+                for status, _ in codex.get(key, ()):
+                    ids = self.statuses.setdefault(status, {}) \
+                        .setdefault(key, [])
+                    if len(ids) == 0 or ids[-1] != id_:
+                        ids.append(id_)
+            self.link(id_, codex, "drops", "dropped_by")
+            self.link(id_, codex, "materials", "material_for")
+            self.link(id_, codex, "spells", "used_by")
+            # the page lists droppers too, which may be missing from drops
+            for source_id in codex.get("dropped_by", ()):
+                if source_id not in codexes:
+                    self.dangling[source_id] += 1
+                    continue
+                sources = self.reverse["dropped_by"].setdefault(id_, [])
+                if source_id not in sources:
+                    sources.append(source_id)
+        if self.dangling:
+            logger.warning("Dangling relations ids=%d edges=%d: %s",
+                           len(self.dangling), sum(self.dangling.values()),
+                           ', '.join(sorted(self.dangling)))
+
+    def link(self, id_, codex, key, reverse_key) -> None:
+        for target_id in codex.get(key, ()):
+            if target_id not in self.codexes:
+                self.dangling[target_id] += 1
+                continue
+            sources = self.reverse[reverse_key].setdefault(target_id, [])
+            if id_ not in sources:
+                sources.append(id_)
+
+    def causes_by_spells(self, codex):
+        causes = {}
+        for spell_id in codex.get("spells", ()):
+            spell = self.codexes.get(spell_id)
+            if spell is None:
+                continue
+            for status, probability in spell.get("causes", ()):
+                current = causes.setdefault(status, {
+                    'probability': 0,
+                    'by': [],
+                })
+                # same spell is listed by many codexes
+                current['by'].append(
+                    sys.intern(f"{spell['name']} ({probability}%)"))
+                if probability is not None \
+                        and probability > current['probability']:
+                    current['probability'] = probability
+        return causes
+
+    def apply(self) -> None:
+        ''' Add reverse edges to codexes, `causes_by_spells` keys first '''
+        for codex in self.codexes.values():
+            causes = self.causes_by_spells(codex)
+            if len(causes) >= 1:
+                codex['causes_by_spells'] = causes
+        for id_, sources in self.reverse["material_for"].items():
+            self.codexes[id_]['material_for'] = list(sources)
+
+    def to_json(self):
+        return {
+            "statuses": {
+                status: {
+                    key: self.statuses[status][key]
+                    for key in STATUS_KEYS if key in self.statuses[status]
+                }
+                for status in sorted(self.statuses)
+            },
+            **{
+                key: {id_: edges[id_] for id_ in sorted(edges)}
+                for key, edges in self.reverse.items()
+            },
+        }
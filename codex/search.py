@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Search index of codex names in all exported languages.
+
+Names are lowercased like the web client does, then split into n-grams.
+Each gram maps to sorted positions in `ids`. A query of at least n
+characters is answered by intersecting postings of its grams and then
+checking candidates with substring match; a shorter query takes the
+union of postings of grams containing it.
+'''
+
+import logging
+import sys
+import time
+
+from utils import write_json
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def normalize(name: str) -> str:
+    return name.lower()
+
+
+def grams_of(string: str, n: int) -> set[str]:
+    if len(string) <= n:
+        return {sys.intern(string)} if string else set()
+    # grams repeat over names, keep one copy of each
+    return {sys.intern(string[i:i + n]) for i in range(len(string) - n + 1)}
+
+
+class SearchIndex:
+    VERSION = 1
+
+    def __init__(self, n=2):
+        self.n = n
+        # codex id -> grams, kept per codex so entries can be replaced
+        self.entries = {}
+
+    def add(self, id_: str, names) -> None:
+        grams = set()
+        for name in names:
+            grams |= grams_of(normalize(name), self.n)
+        self.entries[id_] = grams
+
+    def remove(self, id_: str) -> None:
+        self.entries.pop(id_, None)
+
+    @classmethod
+    def build(cls, codexes, n=2):
+        ''' Build from codexes of all languages, {lang: {id: codex}} '''
+        start = time.perf_counter()
+        index = cls(n)
+        names = {}
+        for lang_codexes in codexes.values():
+            for id_, codex in lang_codexes.items():
+                names.setdefault(id_, []).append(codex['name'])
+        for id_, values in names.items():
+            index.add(id_, values)
+        logger.info("Built search index ids=%d in %.3fs",
+                    len(index.entries), time.perf_counter() - start)
+        return index
+
+    def to_json(self):
+        ids = sorted(self.entries)
+        postings = {}
+        for position, id_ in enumerate(ids):
+            for gram in self.entries[id_]:
+                postings.setdefault(gram, []).append(position)
+        return {
+            "version": self.VERSION,
+            "n": self.n,
+            "ids": ids,
+            "grams": {gram: postings[gram] for gram in sorted(postings)},
+        }
+
+    def write(self, path: str, compact=False, compress=()) -> None:
+        size = write_json(path, self.to_json(), compact, compress)
+        logger.info("Written search index grams=%d bytes=%d",
+                    len(set().union(*self.entries.values())), size)
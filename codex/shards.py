@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Sharded layout of exported data, for clients loading data on demand.
+
+    shards/manifest.json         languages and files, with content hashes
+    shards/{lang}/list.json      text, category, options and list fields
+    shards/{lang}/{category}.json   full codexes of the category
+'''
+
+import logging
+import os
+
+from utils import content_hash, write_json
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Fields rendered by CodexList, with its LinkButtons
+LIST_FIELDS = (
+    "name", "category", "tier", "image_url",
+    "exotic", "events", "place", "useableBy",
+    "path", "ornaguide_id", "ornaguide_category",
+)
+
+
+class ShardWriter:
+    def __init__(self, directory, compact=False, compress=()):
+        self.directory = os.path.join(directory, "shards")
+        self.compact = compact
+        self.compress = compress
+        self.languages = {}
+
+    def write_file(self, name, data):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json(path, data, compact=self.compact, compress=self.compress)
+        return {"path": name, "hash": content_hash(data)}
+
+    def write(self, lang, data):
+        ''' Write list and category shards of a language '''
+        shards = {}
+        for id_, codex in data['codex'].items():
+            category = codex['category']
+            if category not in shards:
+                shards[category] = {}
+            shards[category][id_] = codex
+
+        # facets are exported if asked
+        listing = {
+            key: data[key]
+            for key in ("text", "category", "options", "facets") if key in data
+        }
+        listing['codex'] = {
+            id_: {key: codex[key] for key in LIST_FIELDS if key in codex}
+            for id_, codex in data['codex'].items()
+        }
+        self.languages[lang] = {
+            "list": self.write_file(f"{lang}/list.json", listing),
+            "shards": {
+                category: self.write_file(f"{lang}/{category}.json", codexes)
+                for category, codexes in sorted(shards.items())
+            },
+        }
+        logger.info("Written shards lang=%s categories=%d",
+                    lang, len(shards))
+
+    def write_manifest(self):
+        write_json(os.path.join(self.directory, "manifest.json"), {
+            "languages": self.languages,
+        }, compact=self.compact)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Stage level instrumentation of a run.
+
+A stage accumulates wall and CPU time, HTTP requests, cache hits and bytes
+received from network over all its calls. For memory it accumulates how
+much the peak RSS rose during its calls, which tells the stages setting
+the peak of the run, and samples the current RSS when it ends. CPU time
+and peak RSS include worker processes once they are joined, current RSS
+is of this process only. Stages do not nest. With a profile directory,
+each stage is also profiled into {directory}/{stage}.prof, readable by
+pstats.
+'''
+
+import cProfile
+import logging
+import os
+import resource
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from utils import write_json
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def usage():
+    ''' CPU seconds and peak RSS in KiB of this process and its children '''
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    return cpu, max(own.ru_maxrss, children.ru_maxrss)
+
+
+def current_rss():
+    ''' Current RSS in KiB of this process, 0 where /proc is missing '''
+    try:
+        with open("/proc/self/statm", 'r', encoding='ascii') as file:
+            pages = int(file.read().split()[1])
+    except OSError:
+        return 0
+    return pages * resource.getpagesize() // 1024
+
+
+class Telemetry:
+    def __init__(self, profile_dir=None) -> None:
+        self.profile_dir = profile_dir
+        self.sessions = []
+        self.stages = {}
+        self.profiles = {}
+        self.started = time.perf_counter()
+
+    def watch(self, http) -> None:
+        ''' Count requests of `HttpSession` in stages '''
+        self.sessions.append(http)
+
+    def http_stats(self) -> Counter:
+        stats = Counter()
+        for http in self.sessions:
+            with http.report_lock:
+                stats.update(http.stats)
+        return stats
+
+    @contextmanager
+    def stage(self, name: str):
+        stats = self.stages.setdefault(name, Counter())
+        profile = None
+        if self.profile_dir is not None:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        wall = time.perf_counter()
+        cpu, peak = usage()
+        http = self.http_stats()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            end_cpu, end_peak = usage()
+            stats['calls'] += 1
+            stats['wall_seconds'] += time.perf_counter() - wall
+            stats['cpu_seconds'] += end_cpu - cpu
+            stats.update(self.http_stats() - http)
+            stats['peak_rss_raised_kb'] += end_peak - peak
+            stats['rss_kb'] = current_rss()
+
+    def report(self) -> dict:
+        _, rss = usage()
+        stages = {}
+        for name, stats in self.stages.items():
+            stages[name] = {
+                "calls": stats['calls'],
+                "wall_seconds": round(stats['wall_seconds'], 3),
+                "cpu_seconds": round(stats['cpu_seconds'], 3),
+                "requests": stats['requests'],
+                "cache_hits": stats['cache_hits'],
+                "bytes": stats['bytes'],
+                "peak_rss_raised_kb": stats['peak_rss_raised_kb'],
+                "rss_kb": stats['rss_kb'],
+            }
+        return {
+            "wall_seconds": round(time.perf_counter() - self.started, 3),
+            "peak_rss_kb": rss,
+            "stages": stages,
+        }
+
+    def finish(self, report_path=None) -> None:
+        ''' Log stages, write report and profiles if configured '''
+        report = self.report()
+        for name, stats in report['stages'].items():
+            logger.info("Stage %s wall=%.3fs cpu=%.3fs requests=%d "
+                        "cache_hits=%d bytes=%d peak_rss_raised_kb=%d "
+                        "rss_kb=%d", name, stats['wall_seconds'],
+                        stats['cpu_seconds'], stats['requests'],
+                        stats['cache_hits'], stats['bytes'],
+                        stats['peak_rss_raised_kb'], stats['rss_kb'])
+        if report_path is not None:
+            write_json(report_path, report)
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            for name, profile in self.profiles.items():
+                profile.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+            logger.info("Written profiles of stages=%d to %s",
+                        len(self.profiles), self.profile_dir)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# coding: utf-8
+'''
+Columnar encoding of exports of the fixture corpus decodes to the exports.
+
+    python -m unittest discover -s codex
+'''
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import columnar
+from exporter import Exporter
+from record import json_default
+from utils import ResponseArchive
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=json_default)
+
+
+class ColumnarTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.archive = ResponseArchive.load(os.path.join(FIXTURES, "corpus.zip"))
+
+    def setUp(self):
+        # caches and reports of the run stay out of CACHE_DIR of main.py
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.dict(os.environ, {"CACHE_DIR": directory.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def export(self, **options):
+        exporter = Exporter(
+            os.path.join(FIXTURES, "index.txt"), ["en", "zh-hans"],
+            parse_cache=False, backend="lxml",
+            http_options={"rate_limit": 0, "archive": self.archive,
+                          "replay": True},
+            **options)
+        exporter.prepare()
+        return list(exporter.export())
+
+    def check_round_trip(self, exports):
+        for lang, data in exports:
+            with self.subTest(lang=lang):
+                self.assertGreater(len(data['codex']), 0)
+                encoded = json.loads(dumps(columnar.encode(data)))
+                self.assertEqual(dumps(columnar.decode(encoded)), dumps(data))
+
+    def test_round_trip(self):
+        self.check_round_trip(self.export())
+
+    def test_round_trip_with_facets_and_relations(self):
+        self.check_round_trip(self.export(facets=True, relations=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,42 +2,453 @@
 # coding: utf-8
 # pylint: disable=abstract-method
 
+import gzip
+import hashlib
+import json
 import logging
 import os
+import random
+import sqlite3
 import tempfile
-from datetime import datetime, timedelta
+import threading
+import time
+import zipfile
+from collections import Counter, OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import Executor, Future
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from http.cookies import SimpleCookie
+from io import BytesIO
+from urllib.parse import urlsplit
 
 import requests_cache
+from record import json_default
+from requests import Response, exceptions
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.response import HTTPResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+def cache_path(name: str) -> str:
+    directory = os.environ.get("CACHE_DIR", tempfile.gettempdir())
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+class RateLimiter:
+    ''' Limit requests per second for each host '''
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_slots = {}
+
+    def acquire(self, host: str) -> None:
+        if self.interval <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slots.get(host, now))
+            self.next_slots[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class TokenBucket:
+    ''' Limit requests per second over all hosts, allowing short bursts '''
+
+    def __init__(self, rate: float, burst=1) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # take the token now, sleep until it is refilled if owed
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def retry_after(resp):
+    ''' Seconds to wait by Retry-After header, either seconds or HTTP date '''
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class TransportAdapter(HTTPAdapter):
+    ''' Transport of requests which actually go to network
+
+    Applies the per host and global rate limits and a default timeout, and
+    retries connection errors, timeouts, 429 and 5xx responses with
+    jittered exponential backoff, honoring Retry-After.
+    '''
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, limiter: RateLimiter, bucket: TokenBucket,
+                 timeout=30, retries=3, backoff=1.0, max_backoff=60,
+                 **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.limiter = limiter
+        self.bucket = bucket
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.statuses = Counter()
+        self.retried = Counter()
+
+    def delay_of(self, attempt: int, resp=None) -> float:
+        delay = retry_after(resp) if resp is not None else None
+        if delay is None:
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+        return min(delay, self.max_backoff)
+
+    def send(self, request, *args, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        host = urlsplit(request.url).hostname
+        attempt = 0
+        while True:
+            self.limiter.acquire(host)
+            self.bucket.acquire()
+            try:
+                resp = super().send(request, *args, **kwargs)
+            except (exceptions.ConnectionError, exceptions.Timeout) as exc:
+                if attempt >= self.retries:
+                    raise
+                reason, delay = type(exc).__name__, self.delay_of(attempt)
+            else:
+                with self.lock:
+                    self.statuses[resp.status_code] += 1
+                if resp.status_code not in self.RETRY_STATUSES \
+                        or attempt >= self.retries:
+                    return resp
+                reason, delay = resp.status_code, self.delay_of(attempt, resp)
+                resp.close()
+            with self.lock:
+                self.retried[reason] += 1
+            logger.warning("Retry %s in %.1fs after %s (%d/%d)",
+                           request.url, delay, reason,
+                           attempt + 1, self.retries)
+            time.sleep(delay)
+            attempt += 1
+
+    def report(self) -> dict:
+        def counts(counter):
+            return ','.join(
+                f"{key}:{count}" for key, count in
+                sorted(counter.items(), key=lambda item: str(item[0]))) or '-'
+        with self.lock:
+            return {
+                "statuses": counts(self.statuses),
+                "retries": counts(self.retried),
+            }
+
+
+def cache_key(request, **_kwargs) -> str:
+    ''' Cache key by method, URL, language cookie and body only
+
+    Other headers and cookies do not change the response, so changing the
+    user agent does not invalidate the cache.
+    '''
+    cookies = SimpleCookie(request.headers.get('Cookie', ''))
+    lang = cookies['ornalang'].value if 'ornalang' in cookies else ''
+    body = getattr(request, 'body', None) or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    hasher = hashlib.sha256()
+    for part in (request.method, request.url, lang):
+        hasher.update(part.encode('utf-8'))
+        hasher.update(b'\0')
+    hasher.update(body)
+    return hasher.hexdigest()[:32]
+
+
+class CacheStorage(MutableMapping):
+    ''' Storage of cached responses with in-memory LRU layer and counters '''
+
+    def __init__(self, storage, memory_size=0) -> None:
+        self.storage = storage
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.memory_hits = 0
+        self.lookup_seconds = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def remember(self, key, value) -> None:
+        if self.memory_size <= 0:
+            return
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+    def __getitem__(self, key):
+        start = time.perf_counter()
+        hit = False
+        try:
+            with self.lock:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    self.memory_hits += 1
+                    hit = True
+                    return self.memory[key]
+            value = self.storage[key]
+            self.remember(key, value)
+            hit = True
+            return value
+        finally:
+            # session is shared by threads of crawl and orna.guide
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.lookups += 1
+                if hit:
+                    self.hits += 1
+                self.lookup_seconds += elapsed
+
+    def __setitem__(self, key, value) -> None:
+        self.storage[key] = value
+        self.remember(key, value)
+
+    def __delitem__(self, key) -> None:
+        with self.lock:
+            self.memory.pop(key, None)
+        del self.storage[key]
+
+    def __iter__(self):
+        return iter(self.storage)
+
+    def __len__(self) -> int:
+        return len(self.storage)
+
+    def bulk_delete(self, keys) -> None:
+        keys = list(keys)
+        with self.lock:
+            for key in keys:
+                self.memory.pop(key, None)
+        self.storage.bulk_delete(keys)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.memory.clear()
+        self.storage.clear()
+
+    def report(self) -> dict:
+        lookups = max(self.lookups, 1)
+        return {
+            "cache_hit_rate": f"{self.hits / lookups:.2f}",
+            "cache_memory_hits": self.memory_hits,
+            "cache_lookup_ms": f"{self.lookup_seconds / lookups * 1000:.2f}",
+        }
+
+
+class ResponseArchive:
+    ''' Snapshot of responses by cache key, saved as a zip archive
+
+        responses.json      {key: {"method", "url", "status", "headers"}}
+        bodies/{key}        decoded response body
+    '''
+
+    # Headers describing the transfer, not valid for the decoded body
+    SKIPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding'}
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.bodies = {}
+
+    @classmethod
+    def load(cls, path: str):
+        archive = cls(path)
+        with zipfile.ZipFile(path) as file:
+            archive.responses = json.loads(file.read("responses.json"))
+            for key in archive.responses:
+                archive.bodies[key] = file.read(f"bodies/{key}")
+        logger.info("Loaded archive path=%s responses=%d",
+                    path, len(archive.responses))
+        return archive
+
+    def add(self, resp) -> None:
+        key = cache_key(resp.request)
+        with self.lock:
+            self.responses[key] = {
+                "method": resp.request.method,
+                "url": resp.url,
+                "status": resp.status_code,
+                "headers": {
+                    name: value for name, value in resp.headers.items()
+                    if name.lower() not in self.SKIPPED_HEADERS
+                },
+            }
+            self.bodies[key] = resp.content
+
+    def save(self) -> None:
+        file = AtomicFile(self.path)
+        try:
+            with zipfile.ZipFile(file.file, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr("responses.json", json.dumps(
+                    self.responses, ensure_ascii=False, sort_keys=True))
+                for key in sorted(self.bodies):
+                    archive.writestr(f"bodies/{key}", self.bodies[key])
+        except BaseException:
+            file.close(commit=False)
+            raise
+        file.close()
+        logger.info("Saved archive path=%s responses=%d bytes=%d",
+                    self.path, len(self.responses), os.path.getsize(self.path))
+
+    def response_of(self, request):
+        key = cache_key(request)
+        if key not in self.responses:
+            raise exceptions.ConnectionError(
+                f"{request.method} {request.url} is not in archive "
+                f"'{self.path}'.", request=request)
+        meta = self.responses[key]
+        resp = Response()
+        resp.status_code = meta["status"]
+        resp.headers = CaseInsensitiveDict(meta["headers"])
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp.raw = HTTPResponse(
+            body=BytesIO(self.bodies[key]),
+            headers=meta["headers"],
+            status=meta["status"],
+            preload_content=False)
+        resp.url = meta["url"]
+        resp.request = request
+        return resp
+
+
+class ReplayAdapter(BaseAdapter):
+    ''' Serve requests from `ResponseArchive` without network '''
+
+    def __init__(self, archive: ResponseArchive) -> None:
+        super().__init__()
+        self.archive = archive
+
+    def send(self, request, *args, **kwargs):  # pylint: disable=arguments-differ
+        return self.archive.response_of(request)
+
+    def close(self) -> None:
+        pass
+
+
+def cache_backend(name: str):
+    if name == "sqlite":
+        return requests_cache.SQLiteCache(
+            cache_path("http_cache.sqlite"), wal=True)
+    if name == "filesystem":
+        return requests_cache.FileCache(cache_path("http_cache"))
+    raise ValueError(f"Unknown cache backend '{name}'.")
+
+
 class HttpSession(requests_cache.CachedSession):
-    def __init__(self) -> None:
-        cache = os.path.join(
-            os.environ.get("CACHE_DIR", tempfile.gettempdir()),
-            "http_cache.sqlite")
+    ''' Cached HTTP session
+
+    Cache is configured by environment variables: CACHE_DIR, CACHE_BACKEND
+    (sqlite or filesystem) and CACHE_MEMORY_SIZE (number of responses kept
+    in memory in front of the backend, 0 to disable).
+    '''
+
+    def __init__(self, rate_limit=10, pool_size=10, global_rate_limit=0,
+                 timeout=30, retries=3, archive=None, replay=False) -> None:
         super().__init__(
-            cache,
-            backend='sqlite',
+            # replay is a run on fixed data, independent of the disk cache
+            backend="memory" if replay else
+            cache_backend(os.environ.get("CACHE_BACKEND", "sqlite")),
             expire_after=timedelta(hours=22),
             allowable_methods=['GET', 'POST'],
             allowable_codes=[200, 404],
-            match_headers=True,
+            key_fn=cache_key,
+        )
+        self.cache.responses = CacheStorage(
+            self.cache.responses,
+            memory_size=int(os.environ.get("CACHE_MEMORY_SIZE", "256")))
+        self.transport = TransportAdapter(
+            RateLimiter(rate_limit),
+            TokenBucket(global_rate_limit, burst=pool_size),
+            timeout=timeout,
+            retries=retries,
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
         )
+        self.mount("https://", self.transport)
+        # responses are recorded to archive, or served from it on replay
+        self.archive = archive
+        self.replay = replay
+        if replay:
+            self.mount("https://", ReplayAdapter(archive))
+            self.mount("http://", ReplayAdapter(archive))
         self.request_count = 0
         self.last_reported_count = datetime.now()
+        self.report_lock = threading.Lock()
+        # totals of the session: requests, cache_hits and bytes from network
+        self.stats = Counter()
+        # callables returning extra counters for the periodic log
+        self.reporters = [self.cache.responses.report, self.transport.report]
 
     def request(self, *args, **kwargs):
-        if datetime.now() - self.last_reported_count >= timedelta(seconds=10):
-            logger.info("Maked %d HTTP requests in last %s",
-                        self.request_count,
-                        datetime.now() - self.last_reported_count)
-            self.request_count = 0
-            self.last_reported_count = datetime.now()
-        self.request_count += 1
-        return super().request(*args, **kwargs)
+        with self.report_lock:
+            if datetime.now() - self.last_reported_count >= timedelta(seconds=10):
+                extras = ''.join(
+                    f" {key}={value}"
+                    for reporter in self.reporters
+                    for key, value in reporter().items())
+                logger.info("Maked %d HTTP requests in last %s%s",
+                            self.request_count,
+                            datetime.now() - self.last_reported_count,
+                            extras)
+                self.request_count = 0
+                self.last_reported_count = datetime.now()
+            self.request_count += 1
+        resp = super().request(*args, **kwargs)
+        with self.report_lock:
+            self.stats['requests'] += 1
+            if getattr(resp, 'from_cache', False):
+                self.stats['cache_hits'] += 1
+            else:
+                self.stats['bytes'] += len(resp.content)
+        if self.archive is not None and not self.replay:
+            self.archive.add(resp)
+        return resp
 
     def get_playorna_com(self, path, lang) -> requests_cache.Response:
         return self.get(
@@ -57,6 +468,223 @@ class HttpSession(requests_cache.CachedSession):
             })
 
 
+def content_hash(data) -> str:
+    string = json.dumps(data, ensure_ascii=False, sort_keys=True,
+                        default=json_default)
+    return hashlib.sha256(string.encode('utf-8')).hexdigest()[:16]
+
+
+class SerialExecutor(Executor):
+    ''' Executor running calls in current thread immediately '''
+
+    def submit(self, fn, /, *args, **kwargs):  # pylint: disable=arguments-differ
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as exc:  # pylint: disable=broad-except
+            future.set_exception(exc)
+        return future
+
+
+class ParseCache:
+    ''' Persistent cache of parsed codexes by path, language and page hash '''
+
+    def __init__(self, version) -> None:
+        self.version = version
+        self.db = sqlite3.connect(cache_path("parse_cache.sqlite"))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS codexes ("
+            " path TEXT, lang TEXT, digest TEXT, codex TEXT,"
+            " PRIMARY KEY (path, lang))")
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, html: str) -> str:
+        # parser version is part of digest to drop entries of older parser
+        return hashlib.sha256(
+            f"{self.version}\n{html}".encode('utf-8')).hexdigest()
+
+    def get(self, path: str, lang: str, digest: str):
+        row = self.db.execute(
+            "SELECT codex FROM codexes WHERE path=? AND lang=? AND digest=?",
+            (path, lang, digest)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, path: str, lang: str, digest: str, codex) -> None:
+        self.db.execute(
+            "REPLACE INTO codexes (path, lang, digest, codex) VALUES (?,?,?,?)",
+            (path, lang, digest, json.dumps(codex, ensure_ascii=False)))
+
+    def evict(self, paths) -> int:
+        ''' Remove entries whose path is not in paths '''
+        paths = set(paths)
+        stale = [
+            (path,) for (path,) in
+            self.db.execute("SELECT DISTINCT path FROM codexes")
+            if path not in paths
+        ]
+        self.db.executemany("DELETE FROM codexes WHERE path=?", stale)
+        return len(stale)
+
+    def commit(self) -> None:
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+
+class Checkpoint:
+    ''' State of a run saved periodically, to resume it after a failure.
+    A disabled checkpoint is never saved nor loaded. '''
+
+    def __init__(self, name: str, interval=60, enabled=True) -> None:
+        self.path = cache_path(name)
+        self.interval = interval
+        self.enabled = enabled
+        self.saved_at = time.monotonic()
+
+    def due(self) -> bool:
+        return self.enabled and \
+            time.monotonic() - self.saved_at >= self.interval
+
+    def load(self):
+        if not self.enabled:
+            return None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return None
+        logger.info("Loaded checkpoint path=%s", self.path)
+        return state
+
+    def save(self, state) -> None:
+        if not self.enabled:
+            return
+        start = time.perf_counter()
+        size = write_json(self.path, state, compact=True)
+        self.saved_at = time.monotonic()
+        logger.info("Saved checkpoint path=%s bytes=%d in %.3fs",
+                    self.path, size, time.perf_counter() - start)
+
+    def clear(self) -> None:
+        if self.enabled and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class AtomicFile:
+    ''' Binary file written to a temporary path, renamed on success '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        fd, self.temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or '.',
+            prefix=f".{os.path.basename(path)}.")
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+
+    def close(self, commit=True) -> None:
+        self.file.close()
+        if commit:
+            os.chmod(self.temp_path, 0o644)
+            os.replace(self.temp_path, self.path)
+        else:
+            os.remove(self.temp_path)
+
+
+class BrotliFile:
+    def __init__(self, path: str) -> None:
+        if brotli is None:
+            raise RuntimeError("brotli output requires the brotli package")
+        self.file = AtomicFile(path)
+        self.compressor = brotli.Compressor()
+
+    def write(self, data: bytes) -> None:
+        self.file.write(self.compressor.process(data))
+
+    def close(self, commit=True) -> None:
+        self.file.write(self.compressor.finish())
+        self.file.close(commit)
+
+
+class GzipFile:
+    def __init__(self, path: str) -> None:
+        self.file = AtomicFile(path)
+        # fixed mtime keeps output reproducible
+        self.gzip = gzip.GzipFile(
+            filename='', mode='wb', fileobj=self.file, mtime=0)
+
+    def write(self, data: bytes) -> None:
+        self.gzip.write(data)
+
+    def close(self, commit=True) -> None:
+        self.gzip.close()
+        self.file.close(commit)
+
+
+COMPRESSIONS = {
+    "gz": GzipFile,
+    "br": BrotliFile,
+}
+
+
+def check_compressions(compress) -> None:
+    for ext in compress:
+        if ext not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{ext}'.")
+        if ext == "br" and brotli is None:
+            raise RuntimeError("brotli output requires the brotli package")
+
+
+def write_json(path: str, data, compact=False, compress=()) -> int:
+    ''' Write data as JSON chunk by chunk, to path and its compressed copies
+
+    Each file is written to a temporary file first and renamed when whole
+    data is written, so readers never see a partial file. Return the size
+    of uncompressed JSON in bytes.
+    '''
+    if compact:
+        encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'),
+                                   default=json_default)
+    else:
+        encoder = json.JSONEncoder(ensure_ascii=False, indent=2,
+                                   default=json_default)
+    files = []
+    written = 0
+    try:
+        files.append(AtomicFile(path))
+        for ext in compress:
+            files.append(COMPRESSIONS[ext](f"{path}.{ext}"))
+        buffer, size = [], 0
+        for chunk in encoder.iterencode(data):
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= 64 * 1024:
+                block = ''.join(buffer).encode('utf-8')
+                for file in files:
+                    file.write(block)
+                written += len(block)
+                buffer, size = [], 0
+        block = ''.join(buffer).encode('utf-8')
+        for file in files:
+            file.write(block)
+        written += len(block)
+    except BaseException:
+        for file in files:
+            file.close(commit=False)
+        raise
+    for file in files:
+        file.close()
+    return written
+
+
 TEXTS = {
     "en": {
         "category": "Category",